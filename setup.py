@@ -69,6 +69,8 @@ setup(name='trac.por',
             'trac.por = trac.por.plugins',
             'trac.por.users = trac.por.user',
             'trac.por.communication = trac.por.communication',
+            'trac.por.notification = trac.por.notification',
+            'trac.por.ticketindex = trac.por.ticketindex',
             'trac.por.workflow = trac.por.workflow',
         ],
       },
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+In-process caches shared by the trac.por components and monkey patches.
+
+Entries are tagged with a *generation*: a counter per topic (usually the
+name of a penelope model class) that is bumped every time an object of
+that class is flushed through a SQLAlchemy session. A cached value built
+under an older generation is considered stale and rebuilt on next access.
+
+Penelope and trac run on the same wsgi stack, so the counters only see
+changes made by the current process: every cache has a ttl too, which
+bounds how long a change made elsewhere (e.g. by another worker) can go
+unnoticed.
+"""
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+DEFAULT_TTL = 300
+
+_generations = {}
+_generations_lock = threading.Lock()
+
+_caches = {}
+
+
+def get_generation(*topics):
+    """
+    Return the current generation of the given topics, as a tuple.
+    """
+    return tuple([_generations.get(topic, 0) for topic in topics])
+
+
+def bump_generation(*topics):
+    """
+    Invalidate every cached value that depends on any of the given topics.
+    """
+    with _generations_lock:
+        for topic in topics:
+            _generations[topic] = _generations.get(topic, 0) + 1
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe mapping with optional expiration.
+
+    ``ttl`` is expressed in seconds, ``None`` means that entries never expire.
+    The least recently used entry is dropped when ``maxsize`` is exceeded.
+    Named caches are listed by `cache_stats()`.
+    """
+
+    def __init__(self, maxsize=128, ttl=DEFAULT_TTL, name=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        if name:
+            _caches[name] = self
+
+    def lookup(self, key, generation=None):
+        """
+        Return the value stored for `key`. Raise `KeyError` if it is missing,
+        expired or stored under a different `generation`.
+        """
+        with self._lock:
+            try:
+                value, stored_generation, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            if stored_generation != generation or \
+                    (expires is not None and expires < time.time()):
+                self.misses += 1
+                raise KeyError(key)
+            self._data[key] = (value, stored_generation, expires)
+            self.hits += 1
+            return value
+
+    def store(self, key, value, generation=None):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, generation, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def get(self, key, builder, generation=None):
+        """
+        Return the value stored for `key`, calling `builder()` to compute it
+        again when needed.
+        """
+        try:
+            return self.lookup(key, generation)
+        except KeyError:
+            return self.store(key, builder(), generation)
+
+    def invalidate(self, key=None):
+        """
+        Drop the entry for `key`, or every entry if no key is given.
+        """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl}
+
+
+def cache_stats():
+    """
+    Return hit/miss counters and sizes of the named caches.
+    """
+    return dict([(name, cache.stats()) for name, cache in _caches.items()])
+
+
+_hooks_installed = False
+
+
+def _session_after_flush(session, flush_context):
+    topics = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        topics.add(type(obj).__name__)
+    if topics:
+        bump_generation(*topics)
+        # bump them again at commit time: a concurrent request could have
+        # cached the old rows between the flush and the commit
+        pending = session.__dict__.setdefault('_por_flushed_topics', set())
+        pending.update(topics)
+
+
+def _session_after_commit(session):
+    topics = session.__dict__.pop('_por_flushed_topics', None)
+    if topics:
+        bump_generation(*topics)
+
+
+def install_session_hooks():
+    """
+    Bump the generation of every model class flushed through a SQLAlchemy
+    session, i.e. through penelope's DBSession.
+    """
+    global _hooks_installed
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    if not _hooks_installed:
+        event.listen(Session, 'after_flush', _session_after_flush)
+        event.listen(Session, 'after_commit', _session_after_commit)
+        _hooks_installed = True
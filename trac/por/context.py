@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Penelope objects needed while serving a trac request, loaded once.
+"""
+
+import threading
+
+from contextlib import contextmanager
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from penelope.core.models import DBSession
+from penelope.core.models.dashboard import CustomerRequest, Group, Project, User
+from penelope.core.models.dashboard import group_assignments, role_assignments
+from penelope.core.security.acl import ONLY_PROJECT_ROLES
+
+
+def email_key(email):
+    """
+    Key of the given email (trac username) in the project roles.
+    """
+    return email and email.lower()
+
+
+# the local role of the members of a project group without roles, as in
+# penelope's Group.roles_names
+NO_ROLE = u'[No role]'
+
+
+def load_project_roles(session, project):
+    """
+    Return a dict mapping the lowercased email of every user with a role in
+    `project` to the frozenset of those roles.
+
+    Computes what ``User.roles_in_context(project)`` does one user at a time
+    (see penelope.core.security.acl) with a constant number of queries.
+    """
+    global_roles = {}
+    for email, role_id in session.query(User.email, role_assignments.c.role_id)\
+            .join(role_assignments, role_assignments.c.principal_id == User.id):
+        global_roles.setdefault(email_key(email), set()).add(role_id.lower())
+
+    local_roles = {}
+    local_developers = set()
+    local_managers = set()
+    for email, project_id, role_id in session.query(User.email, Group.project_id, role_assignments.c.role_id)\
+            .join(group_assignments, group_assignments.c.user_id == User.id)\
+            .join(Group, Group.id == group_assignments.c.group_id)\
+            .outerjoin(role_assignments, role_assignments.c.principal_id == Group.id)\
+            .filter((Group.project_id == project.id) |
+                    func.lower(role_assignments.c.role_id).in_([u'internal_developer', u'project_manager'])):
+        email = email_key(email)
+        role_id = role_id.lower() if role_id else NO_ROLE
+        if project_id == project.id:
+            local_roles.setdefault(email, set()).add(role_id)
+        if role_id == u'internal_developer':
+            local_developers.add(email)
+        elif role_id == u'project_manager':
+            local_managers.add(email)
+    for (email,) in session.query(User.email)\
+            .join(Project, Project.manager_id == User.id):
+        local_managers.add(email_key(email))
+
+    manager = project.manager and email_key(project.manager.email)
+    author = project.author and email_key(project.author.email)
+
+    roles = {}
+    emails = set(global_roles) | set(local_roles) | local_developers | local_managers
+    for email in emails | set([manager, author]):
+        if email is None:
+            continue
+        user_roles = set(global_roles.get(email, []))
+        is_admin = u'administrator' in user_roles
+        if not is_admin:
+            if email in local_developers:
+                user_roles.add(u'local_developer')
+            if email in local_managers:
+                user_roles.add(u'local_project_manager')
+        user_roles -= ONLY_PROJECT_ROLES
+        if email == author:
+            user_roles.add(u'owner')
+        if email == manager:
+            user_roles.add(u'project_manager')
+        if not is_admin:
+            user_roles.update(local_roles.get(email, []))
+        if user_roles:
+            roles[email] = frozenset(user_roles)
+    return roles
+
+
+class PorContext(object):
+    """
+    Identity map of the current project, its customer and the users and
+    customer requests looked up while serving a request.
+
+    A context is bound to the DBSession transaction it has been created in,
+    that is to a single request in penelope: objects are never shared among
+    requests.
+    """
+
+    def __init__(self, session, project_id):
+        self.session = session
+        self.project_id = project_id
+        self._project = None
+        self._project_roles = None
+        self._users = {}
+        self._customer_requests = {}
+
+    @property
+    def project(self):
+        if self._project is None:
+            self._project = self.session.query(Project).get(self.project_id)
+        return self._project
+
+    @property
+    def customer(self):
+        return self.project and self.project.customer
+
+    @property
+    def project_roles(self):
+        """
+        The roles of all the users with a role in the project, by email.
+        """
+        if self._project_roles is None:
+            self._project_roles = {}
+            if self.project:
+                self._project_roles = load_project_roles(self.session, self.project)
+        return self._project_roles
+
+    def get_user(self, email):
+        """
+        Return the penelope user with the given email (trac username), or None.
+        """
+        try:
+            return self._users[email]
+        except KeyError:
+            user = self.session.query(User).filter_by(email=email).first()
+            return self._users.setdefault(email, user)
+
+    def get_roles(self, email):
+        """
+        Return the names of the roles of the given user in the project.
+        """
+        return list(self.project_roles.get(email_key(email), []))
+
+    def load_customer_requests(self, cr_ids):
+        """
+        Load the given customer requests with a single query.
+        """
+        missing = set([cr_id for cr_id in cr_ids
+                       if cr_id and cr_id not in self._customer_requests])
+        if missing:
+            for cr in self.session.query(CustomerRequest).filter(CustomerRequest.id.in_(missing)):
+                self._customer_requests[cr.id] = cr
+            for cr_id in missing:
+                self._customer_requests.setdefault(cr_id, None)
+
+    def get_customer_request(self, cr_id):
+        if not cr_id:
+            return None
+        try:
+            return self._customer_requests[cr_id]
+        except KeyError:
+            cr = self.session.query(CustomerRequest).get(cr_id)
+            return self._customer_requests.setdefault(cr_id, cr)
+
+
+# sessions replacing DBSession in get_context, by thread
+_local = threading.local()
+
+
+@contextmanager
+def short_lived_session():
+    """
+    Make the PorContexts of the current thread use a new session, closed on
+    exit (its connection goes back to the pool), instead of the request
+    DBSession. For requests idling between lookups, e.g. long polls.
+    """
+    session = Session(bind=DBSession.bind)
+    _local.session = session
+    try:
+        yield session
+    finally:
+        del _local.session
+        session.close()
+
+
+def get_context(env):
+    """
+    Return the PorContext of the trac environment for the current request,
+    or None if the environment is not bound to a penelope project.
+    """
+    project_id = env.config.get('por-dashboard', 'project-id')
+    if not project_id:
+        return None
+    session = getattr(_local, 'session', None) or DBSession()
+    transaction, contexts = session.__dict__.get('_por_contexts', (None, None))
+    if transaction is not session.transaction:
+        contexts = {}
+        session._por_contexts = (session.transaction, contexts)
+    try:
+        return contexts[project_id]
+    except KeyError:
+        return contexts.setdefault(project_id, PorContext(session, project_id))
@@ -154,3 +154,34 @@ $(document).ready(function() {
 });
 
 
+
+
+
+//
+// page through the ticket time entries
+//
+$(document).ready(function() {
+    "use strict";
+
+    $('#timeentries_more a').click(function(event) {
+        var $link = $(this),
+            $more = $('#timeentries_more');
+        event.preventDefault();
+        $.getJSON($link.attr('href'),
+                  {offset: $link.data('offset')},
+                  function(page) {
+                      $.each(page.entries, function(i, te) {
+                          $('<tr/>').append($('<td/>').text(te.date))
+                                    .append($('<td/>').append($('<a/>').attr('href', te.href).text(te.description || '')))
+                                    .append($('<td/>').text(te.author))
+                                    .append($('<td/>').text(te.hours))
+                                    .insertBefore($more);
+                      });
+                      if (page.next_offset) {
+                          $link.data('offset', page.next_offset);
+                      } else {
+                          $more.remove();
+                      }
+                  });
+    });
+});
@@ -4,6 +4,9 @@ import logging
 from penelope.core.models import DBSession
 from penelope.core.lib.helpers import unicodelower
 
+from trac.por.cache import LRUCache, get_generation, install_session_hooks
+from trac.por.context import get_context
+
 log = logging.getLogger(__name__)
 
 
@@ -62,9 +65,18 @@ def fix_get_custom_fields():
 
     import copy
     from trac.ticket.api import TicketSystem
-    from penelope.core.models.dashboard import Project
 
-    # TODO: cache ?
+    # customer request options, per project; rebuilt when a CR is saved
+    cr_fields_cache = LRUCache(maxsize=256, name='customerrequest_fields')
+
+    def customer_request_fields(env):
+        project = get_context(env).project
+        if project is None:
+            return None
+        options = [cr.id for cr in sorted(project.customer_requests, key=unicodelower)]
+        descriptions = dict([(cr.id, cr.name) for cr in project.customer_requests])
+        return options, descriptions
+
     # TODO: generalizzare
     def TicketSystem_get_custom_fields(self):
         if not is_inside_penelope():        # we are in trac-admin
@@ -72,16 +84,20 @@ def fix_get_custom_fields():
 
         custom_fields = copy.deepcopy(self.custom_fields)
         project_id = self.config.get('por-dashboard', 'project-id')
-        project = None
+        cr_fields = None
         if project_id:
-            project = DBSession().query(Project).get(project_id)
+            cr_fields = cr_fields_cache.get(project_id,
+                            lambda: customer_request_fields(self.env),
+                            generation=get_generation('CustomerRequest'))
         for field in custom_fields:
-            if project and field['name'] == 'customerrequest':
-                field['options'] = [cr.id for cr in sorted(project.customer_requests, key=unicodelower)]
-                field['descriptions'] = dict([(cr.id, cr.name) for cr in project.customer_requests])
-        # TODO: rimuovere il metodo sotto che invalida la cache, trovare
-        # un altro modo per mantenere aggiornati i dati
-        self.reset_ticket_fields()
+            if cr_fields and field['name'] == 'customerrequest':
+                field['options'] = list(cr_fields[0])
+                field['descriptions'] = dict(cr_fields[1])
+        # the ticket fields cached by trac embed the CR options: invalidate
+        # them only when the options have actually changed
+        if self.__dict__.get('_por_cr_fields') != cr_fields:
+            self._por_cr_fields = cr_fields
+            self.reset_ticket_fields()
         return custom_fields
 
     TicketSystem.get_custom_fields = TicketSystem_get_custom_fields
@@ -148,21 +164,49 @@ def fix_get_known_users():
     patch per known_user su por
     """
 
+    import itertools
+    from trac.cache import CacheManager
     from trac.env import Environment
-    from penelope.core.models.dashboard import Project, User
+    from sqlalchemy import func
+    from penelope.core.models.dashboard import User
+
+    # project members by project; rebuilt when users, groups, roles or the
+    # project are flushed in this process, or in every process through
+    # invalidate_known_users_cache
+    known_users_cache = LRUCache(maxsize=256, name='known_users')
+    known_users_id = 'trac.por.monkey.known_users'
+    known_users_versions = itertools.count()
+
+    def known_users_version(env):
+        # trac keeps the generation of known_users_id in its cache table,
+        # shared by all processes and read once per request
+        return CacheManager(env).get(known_users_id,
+                                     lambda instance, db: known_users_versions.next(),
+                                     None)
+
+    def project_members(context):
+        emails = context.project_roles.keys()
+        if not emails:
+            return []
+        return [tuple(row) for row in
+                context.session.query(User.login, User.fullname, User.email)\
+                               .filter(func.lower(User.email).in_(emails))\
+                               .order_by(User.fullname)]
 
-    # TODO: cache ?
-    # TODO: esistono api piu' semplici su por per la stessa richiesta?
     def Environment_get_known_users(self, cnx=None):
-        project_id = self.config.get('por-dashboard', 'project-id')
-        project = None
-        if project_id:
-            db = DBSession()
-            project = db.query(Project).get(project_id)
-            for user in db.query(User).all():
-                if user.roles_in_context(project):
-                    yield user.login, user.fullname, user.email
-
+        context = get_context(self)
+        if context:
+            members = known_users_cache.get(context.project_id,
+                            lambda: project_members(context),
+                            generation=(get_generation('User', 'Group', 'Role', 'Project'),
+                                        known_users_version(self)))
+            for login, fullname, email in members:
+                yield login, fullname, email
+
+    def Environment_invalidate_known_users_cache(self):
+        CacheManager(self).invalidate(known_users_id)
+
+    Environment.invalidate_known_users_cache = Environment_invalidate_known_users_cache
     Environment.get_known_users = Environment_get_known_users
 
 
@@ -172,22 +216,23 @@ def fix_customer_request_changelog_description():
     """
 
     from trac.ticket.web_ui import TicketModule
-    from penelope.core.models.dashboard import CustomerRequest
 
     _grouped_changelog_entries = TicketModule.grouped_changelog_entries
     def TicketModule_grouped_changelog_entries(self, ticket, db, when=None):
-        ret = _grouped_changelog_entries(self, ticket, db, when)
-        for item in ret:
-            try:
-                cr = item['fields']['customerrequest']
-                qry = DBSession().query(CustomerRequest)
-                old_cr = qry.get(cr['old'])
-                new_cr = qry.get(cr['new'])
+        ret = list(_grouped_changelog_entries(self, ticket, db, when))
+        changes = [item['fields']['customerrequest'] for item in ret
+                   if 'customerrequest' in item['fields']]
+        context = get_context(self.env)
+        if changes and context:
+            # one query for the whole changelog, shared with the request
+            context.load_customer_requests([cr['old'] for cr in changes] +
+                                           [cr['new'] for cr in changes])
+            for cr in changes:
+                old_cr = context.get_customer_request(cr['old'])
+                new_cr = context.get_customer_request(cr['new'])
                 cr['old'] = old_cr.name if old_cr else cr['old']
                 cr['new'] = new_cr.name if new_cr else cr['new']
-            except KeyError:
-                pass
-
+        for item in ret:
             yield item
 
     TicketModule.grouped_changelog_entries = TicketModule_grouped_changelog_entries
@@ -198,6 +243,8 @@ def fix_customer_request_dropdown():
     Renders the CR dropdown options grouping them by state
     """
 
+    import copy
+    from sqlalchemy.orm import joinedload
     from trac.ticket.web_ui import TicketModule
     from penelope.core.models.dashboard import CustomerRequest
 
@@ -211,16 +258,23 @@ def fix_customer_request_dropdown():
 
     contract_order = ['active', 'draft','done']
 
-    def contract_sortkey(group):
+    def contract_sortkey(contract):
         try:
-            return contract_order.index(group['label'].workflow_state)
+            return contract_order.index(contract.workflow_state)
         except (AttributeError, ValueError):
             return -1
 
-    def prepare_customerrequest_options(field):
-        qry = DBSession.query(CustomerRequest)
-        options = field['options']
-        customer_requests = [qry.get(op) for op in options]
+    # optgroups by project and CR ids; rebuilt when a CR or a contract is saved
+    optgroups_cache = LRUCache(maxsize=256, name='customerrequest_optgroups')
+
+    def customerrequest_optgroups(options):
+        by_id = {}
+        if options:
+            qry = DBSession.query(CustomerRequest)\
+                           .options(joinedload(CustomerRequest.contract))\
+                           .filter(CustomerRequest.id.in_(options))
+            by_id = dict([(cr.id, cr) for cr in qry])
+        customer_requests = [by_id.get(op) for op in options]
 
         groups = {}
         NO_CONTRACT = 'No contract available'
@@ -229,15 +283,27 @@ def fix_customer_request_dropdown():
                 continue
             contract = cr.contract and cr.contract or NO_CONTRACT
             groups.setdefault(contract, {
-                                    'label': contract,
+                                    'label': unicode(contract),
                                     'options': [],
                                     'descriptions': [],
+                                    'sortkey': contract_sortkey(contract),
                                 })
             groups[contract]['options'].append(cr.id)
             groups[contract]['descriptions'].append(cr.name)
+        optgroups = sorted(groups.values(), key=lambda group: group['sortkey'])
+        for group in optgroups:
+            del group['sortkey']
+        return optgroups
+
+    def prepare_customerrequest_options(env, field):
+        project_id = env.config.get('por-dashboard', 'project-id')
+        options = field['options']
+        optgroups = optgroups_cache.get((project_id, tuple(options)),
+                            lambda: customerrequest_optgroups(options),
+                            generation=get_generation('CustomerRequest', 'Contract'))
         field['options'] = []
         field['descriptions'] = []
-        field['optgroups'] = sorted(groups.values(), key=contract_sortkey)
+        field['optgroups'] = copy.deepcopy(optgroups)
         field['optional'] = True
 
     _prepare_fields = TicketModule._prepare_fields
@@ -245,7 +311,7 @@ def fix_customer_request_dropdown():
         ret = _prepare_fields(self, req, ticket)
         for field in ret:
             if field['name'] == 'customerrequest':
-                prepare_customerrequest_options(field)
+                prepare_customerrequest_options(self.env, field)
 
         return ret
 
@@ -257,41 +323,49 @@ def fix_filter_email_recipents():
     FIX: per evitare mail al customer relativamente a commenti privati e ticket sensibili
     """
     from trac.ticket.notification import TicketNotifyEmail
-    from trac.ticket.web_ui import TicketModule
-    from trac.perm import PermissionSystem
+    from trac.util.datefmt import to_utimestamp
+    from trac.por.user import get_users_permissions
     try:
         import privatecomments; privatecomments
         HAS_PRIVATECOMMENTS = True
     except ImportError:
         HAS_PRIVATECOMMENTS = False
 
+    def is_private_change(db, ticket, when):
+        """
+        Does the change made at `when` carry a private comment?
+        """
+        if not when:
+            return False
+        comment_id = db.cast('p.comment_id', 'text')
+        cursor = db.cursor()
+        # the comment number is stored in oldvalue, as 'cnum' or 'replyto.cnum'
+        # ('%%' is the escaped LIKE wildcard)
+        cursor.execute("""
+            SELECT COUNT(*) FROM ticket_change c
+            INNER JOIN private_comment p ON (p.ticket_id=c.ticket AND p.private>0)
+            WHERE c.ticket=%%s AND c.time=%%s AND c.field='comment'
+            AND (c.oldvalue=%s OR c.oldvalue LIKE %s)""" % (comment_id, db.concat("'%%.'", comment_id)),
+            (int(ticket.id), to_utimestamp(when)))
+        return cursor.fetchone()[0] > 0
 
     TicketNotifyEmail._orig_get_recipients = TicketNotifyEmail.get_recipients
 
     def TicketNotifyEmail_get_recipients(self, tktid):
         (torecipients, ccrecipients) = self._orig_get_recipients(tktid)
-        perm = PermissionSystem(self.env)
+        required = []
         # sensitivetickets
         if self.ticket['sensitive'] == '1':
-            def has_sensisitive_perm(username):
-                return perm.get_user_permissions(username).get('SENSITIVE_VIEW')
-            torecipients = filter(has_sensisitive_perm, torecipients)
-            ccrecipients = filter(has_sensisitive_perm, ccrecipients)            
+            required.append('SENSITIVE_VIEW')
         # privatecomments
-        if HAS_PRIVATECOMMENTS:
-            privatecomment = False
-            for mod in TicketModule(self.env).grouped_changelog_entries(self.ticket, self.db, self.modtime):
-                cursor = self.db.cursor()
-                sql = 'SELECT private FROM private_comment WHERE ticket_id=%d AND comment_id=%d AND private>0'
-                cursor.execute(sql % (int(self.ticket.id), int(mod.get('cnum'))))
-                if cursor.cursor.rowcount:
-                    privatecomment = True
-                cursor.close()
-            if privatecomment:
-                def has_privatecommente_perm(username):
-                    return perm.get_user_permissions(username).get('PRIVATE_COMMENT_PERMISSION')
-                torecipients = filter(has_privatecommente_perm, torecipients)
-                ccrecipients = filter(has_privatecommente_perm, ccrecipients)
+        if HAS_PRIVATECOMMENTS and is_private_change(self.db, self.ticket, self.modtime):
+            required.append('PRIVATE_COMMENT_PERMISSION')
+        if required:
+            permissions = get_users_permissions(self.env, set(torecipients + ccrecipients))
+            def has_required_perms(username):
+                return permissions[username].issuperset(required)
+            torecipients = filter(has_required_perms, torecipients)
+            ccrecipients = filter(has_required_perms, ccrecipients)
         return (torecipients, ccrecipients)
 
     TicketNotifyEmail.get_recipients = TicketNotifyEmail_get_recipients 
@@ -336,7 +410,26 @@ def fix_notification_props():
     TicketNotifyEmail.format_props = TicketNotifyEmail_format_props
 
 
+def fix_environment_shutdown():
+    """
+    Stop the notification spool workers of an environment when it is shut
+    down, e.g. reloaded after a trac.ini change
+    """
+
+    from trac.env import Environment
+    from trac.por.notification import stop_workers
+
+    _shutdown = Environment.shutdown
+    def Environment_shutdown(self, tid=None):
+        if tid is None:
+            stop_workers(self)
+        _shutdown(self, tid)
+
+    Environment.shutdown = Environment_shutdown
+
+
 log.info("Monkey patch")
+install_session_hooks()
 fix_connection_init()
 fix_get_custom_fields()
 fix_send_user_error()
@@ -345,3 +438,4 @@ fix_customer_request_changelog_description()
 fix_customer_request_dropdown()
 fix_filter_email_recipents()
 fix_notification_props()
+fix_environment_shutdown()
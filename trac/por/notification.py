@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous delivery of the Mandrill ticket notifications.
+
+MandrillEmailSender stores the prepared messages in a spool table of the
+trac database; a pool of worker threads delivers them, retrying with an
+exponential backoff. Messages that keep failing are left in the spool with
+the 'dead' status.
+
+Messages due at the same time are grouped into as few Mandrill API calls
+as possible, each recipient getting its own merge vars.
+
+When `[notification] mandrill_coalesce_window` is set, the notifications
+of a ticket are held for that many seconds and the changes made in the
+meantime are merged into a single message per recipient.
+"""
+
+import json
+import threading
+import time
+import weakref
+
+import mandrill
+
+from genshi.core import escape
+from trac.config import ExtensionOption, IntOption
+from trac.core import Component, Interface, implements
+from trac.db import Column, DatabaseManager, Index, Table
+from trac.env import IEnvironmentSetupParticipant
+from trac.web.api import IRequestFilter
+from trac.util.text import exception_to_unicode
+
+
+DB_NAME = 'por_notification_spool'
+DB_VERSION = 1
+
+SCHEMA = [
+    Table('por_notification_spool', key='id')[
+        Column('id', auto_increment=True),
+        Column('ticket'),
+        Column('created', type='int64'),
+        Column('next_attempt', type='int64'),
+        Column('attempts', type='int'),
+        Column('status'),
+        Column('payload'),
+        Column('last_error'),
+        Index(['status', 'next_attempt'])],
+]
+
+QUEUED = 'queued'
+SENDING = 'sending'
+DEAD = 'dead'
+
+# delivery threads by environment path: one pool per process, however many
+# Environment objects are opened on the same path
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+def coalesce_messages(messages):
+    """
+    Merge the Mandrill messages of successive changes of a ticket: the
+    ticket fields come from the last one, change bodies and comments are
+    concatenated.
+    """
+    if len(messages) == 1:
+        return messages[0]
+    merge_vars = [dict([(var['name'], var['content']) for var in message['global_merge_vars']])
+                  for message in messages]
+    params = dict(merge_vars[-1])
+    params['changes_body'] = u''.join([v['changes_body'] for v in merge_vars if v.get('changes_body')])
+    params['change_comment'] = u''.join([u'<p><strong>%s</strong></p>%s' % (escape(v.get('change_author', '')), v['change_comment'])
+                                         for v in merge_vars if v.get('change_comment')])
+    authors = []
+    for v in merge_vars:
+        if v.get('change_author') and v['change_author'] not in authors:
+            authors.append(v['change_author'])
+    params['change_author'] = u', '.join(authors)
+    if [v for v in merge_vars if v.get('ticket_new')]:
+        params['ticket_new'] = True
+
+    message = dict(messages[-1])
+    message['subject'] = messages[0]['subject']
+    message['global_merge_vars'] = [{'name': k, 'content': v} for k, v in params.items()]
+    return message
+
+
+def batch_messages(messages):
+    """
+    Group (template_name, message) pairs into fewer Mandrill messages:
+    messages with the same template, sender and options, addressed to
+    different recipients, are sent together with per-recipient merge vars
+    (subject included). Return a list of (indexes, template_name, message)
+    where `indexes` are the positions of the grouped input messages.
+    """
+    batches = []
+    for index, (template_name, message) in enumerate(messages):
+        key = json.dumps([template_name] + [(k, v) for k, v in sorted(message.items())
+                         if k not in ('to', 'subject', 'global_merge_vars', 'merge_vars')])
+        recipients = set([to['email'] for to in message['to']])
+        for batch in batches:
+            if batch['key'] == key and not batch['recipients'] & recipients:
+                break
+        else:
+            batch = {'key': key, 'template_name': template_name,
+                     'recipients': set(), 'indexes': [], 'messages': []}
+            batches.append(batch)
+        batch['recipients'].update(recipients)
+        batch['indexes'].append(index)
+        batch['messages'].append(message)
+
+    result = []
+    for batch in batches:
+        grouped = batch['messages']
+        message = dict(grouped[0])
+        if len(grouped) > 1:
+            message['to'] = []
+            message['merge_vars'] = []
+            message['global_merge_vars'] = []
+            message['preserve_recipients'] = False
+            if len(set([m['subject'] for m in grouped])) > 1:
+                message['subject'] = u'*|POR_SUBJECT|*'
+            for m in grouped:
+                variables = m.get('global_merge_vars', []) + \
+                            [{'name': 'por_subject', 'content': m['subject']}]
+                for to in m['to']:
+                    message['to'].append(to)
+                    message['merge_vars'].append({'rcpt': to['email'], 'vars': variables})
+        result.append((batch['indexes'], batch['template_name'], message))
+    return result
+
+
+class IMandrillTransport(Interface):
+    """Extension point interface for components delivering messages to
+    Mandrill."""
+
+    def send_template(template_name, message):
+        """Send `message` (a dict as expected by the Mandrill API) rendered
+        with the template `template_name`. Raise an exception on failure."""
+
+
+class MandrillTransport(Component):
+    """Deliver messages through the Mandrill HTTPS API.
+
+    Every thread keeps its own client, so that the HTTP connection to
+    Mandrill is kept alive between two deliveries."""
+    implements(IMandrillTransport)
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def send_template(self, template_name, message):
+        self.client.messages.send_template(template_name=template_name,
+                                           template_content=[],
+                                           message=message)
+
+    @property
+    def client(self):
+        apikey = self.config.get('notification', 'smtp_password')
+        client = getattr(self._local, 'client', None)
+        if client is None or client.apikey != apikey:
+            client = self._local.client = mandrill.Mandrill(apikey)
+        return client
+
+
+class NotificationSpool(Component):
+    """Durable queue of the outgoing notifications."""
+    implements(IEnvironmentSetupParticipant, IRequestFilter)
+
+    transport = ExtensionOption('notification', 'mandrill_transport',
+                                IMandrillTransport, 'MandrillTransport',
+        """Name of the component delivering the spooled notifications.""")
+
+    workers = IntOption('notification', 'mandrill_workers', 2,
+        """Number of threads delivering the spooled notifications, started
+        by the first request served by the environment. With 0
+        notifications stay in the spool until `deliver_pending` is called.""")
+
+    poll_interval = IntOption('notification', 'mandrill_poll_interval', 30,
+        """Seconds between two checks of the spool when no notification has
+        been queued by this process.""")
+
+    retry_delay = IntOption('notification', 'mandrill_retry_delay', 60,
+        """Seconds before retrying a failed delivery, doubled at every
+        attempt.""")
+
+    max_attempts = IntOption('notification', 'mandrill_max_attempts', 8,
+        """Number of delivery attempts before a notification is left in the
+        spool as dead.""")
+
+    batch_size = IntOption('notification', 'mandrill_batch_size', 20,
+        """Maximum number of spooled notifications sent with a single
+        Mandrill API call.""")
+
+    coalesce_window = IntOption('notification', 'mandrill_coalesce_window', 0,
+        """Seconds during which the notifications of a ticket are held, the
+        changes made in the meantime are merged into one message per
+        recipient. 0 disables coalescing.""")
+
+    lease = 300 # seconds a worker owns a claimed notification
+
+    # IEnvironmentSetupParticipant methods
+    def environment_created(self):
+        @self.env.with_transaction()
+        def do_create(db):
+            self.upgrade_environment(db)
+
+    def environment_needs_upgrade(self, db):
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system WHERE name=%s", (DB_NAME,))
+        row = cursor.fetchone()
+        return not row or int(row[0]) < DB_VERSION
+
+    def upgrade_environment(self, db):
+        connector, _ = DatabaseManager(self.env)._get_connector()
+        cursor = db.cursor()
+        for table in SCHEMA:
+            for stmt in connector.to_sql(table):
+                cursor.execute(stmt)
+        cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                       (DB_NAME, str(DB_VERSION)))
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        # the environment serving requests owns the workers: they are
+        # started by its first request and deliver what is left in the
+        # spool without waiting for a new notification. Environments opened
+        # by scripts only enqueue
+        workers = _workers.get(self.env.path)
+        if workers is None or workers.env is None:
+            start_workers(self.env, self.workers, self.poll_interval)
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # public API
+    def enqueue(self, template_name, message, ticket=None):
+        """Store a message to be delivered by the workers."""
+        now = int(time.time())
+        window = ticket and self.coalesce_window or 0
+        recipients = [to['email'] for to in message.get('to', [])]
+
+        @self.env.with_transaction()
+        def do_enqueue(db):
+            cursor = db.cursor()
+            pending = list(recipients)
+            if window > 0:
+                # join the messages of the same ticket still being held
+                cursor.execute("""
+                    SELECT id FROM por_notification_spool
+                    WHERE ticket=%s AND status=%s AND attempts=0 AND next_attempt>%s
+                    ORDER BY id""", (ticket, QUEUED, now))
+                for (id,) in cursor.fetchall():
+                    if pending:
+                        pending = self._join_held(cursor, id, ticket, now,
+                                                  template_name, message, pending)
+            if pending:
+                self._insert(cursor, ticket, now, now + window,
+                             {'template_name': template_name,
+                              'recipients': pending,
+                              'messages': [message]})
+
+        workers = _workers.get(self.env.path)
+        if workers:
+            workers.wakeup.set()
+
+    def deliver_pending(self, limit=None):
+        """Deliver the notifications that are due, return how many have been
+        handled."""
+        count = 0
+        while limit is None or count < limit:
+            size = self.batch_size
+            if limit is not None:
+                size = min(size, limit - count)
+            claimed = self._claim(max(size, 1))
+            if not claimed:
+                break
+            messages = []
+            for id, payload, attempts in claimed:
+                message = coalesce_messages(payload['messages'])
+                message['to'] = [{'email': r} for r in payload['recipients']]
+                messages.append((payload['template_name'], message))
+            for indexes, template_name, message in batch_messages(messages):
+                self._deliver([claimed[i] for i in indexes], template_name, message)
+            count += len(claimed)
+        return count
+
+    # internal methods
+    def _join_held(self, cursor, id, ticket, now, template_name, message, pending):
+        """Merge `message` into the held notification `id` for the `pending`
+        recipients it has too, return the recipients left."""
+        while True:
+            cursor.execute("""
+                SELECT next_attempt, payload FROM por_notification_spool
+                WHERE id=%s AND status=%s AND attempts=0 AND next_attempt>%s""",
+                (id, QUEUED, now))
+            row = cursor.fetchone()
+            if not row: # claimed in the meantime
+                return pending
+            next_attempt, old_payload = row
+            payload = json.loads(old_payload)
+            shared = [r for r in payload['recipients'] if r in pending]
+            if payload['template_name'] != template_name or not shared:
+                return pending
+            merged = dict(payload, recipients=shared,
+                          messages=payload['messages'] + [message])
+            # the payload read is part of the condition: the merge of a
+            # concurrent change of the ticket is not overwritten
+            cursor.execute("""
+                UPDATE por_notification_spool SET payload=%s
+                WHERE id=%s AND status=%s AND next_attempt=%s AND payload=%s""",
+                (json.dumps(merged), id, QUEUED, next_attempt, old_payload))
+            if cursor.rowcount == 1:
+                break
+        others = [r for r in payload['recipients'] if r not in shared]
+        if others:
+            self._insert(cursor, ticket, now, next_attempt,
+                         dict(payload, recipients=others))
+        return [r for r in pending if r not in shared]
+
+    def _insert(self, cursor, ticket, created, next_attempt, payload):
+        cursor.execute("""
+            INSERT INTO por_notification_spool
+                (ticket, created, next_attempt, attempts, status, payload)
+            VALUES (%s, %s, %s, 0, %s, %s)""",
+            (ticket, created, next_attempt, QUEUED, json.dumps(payload)))
+
+    def _claim(self, limit):
+        """Take ownership of up to `limit` due notifications, return a list
+        of (id, payload, number of past attempts). Notifications whose lease
+        expired count as a failed attempt: a message crashing its worker
+        ends up dead too."""
+        now = int(time.time())
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("""
+            SELECT id, status, next_attempt, attempts, payload FROM por_notification_spool
+            WHERE status IN (%s, %s) AND next_attempt<=%s
+            ORDER BY next_attempt, id LIMIT %s""", (QUEUED, SENDING, now, limit))
+        candidates = cursor.fetchall()
+        claimed = []
+
+        @self.env.with_transaction()
+        def do_claim(db):
+            cursor = db.cursor()
+            for id, status, next_attempt, attempts, payload in candidates:
+                if status == SENDING:
+                    attempts += 1
+                if attempts >= self.max_attempts:
+                    self.log.error("Notification %s dropped after %s interrupted attempts",
+                                   id, attempts)
+                    cursor.execute("""
+                        UPDATE por_notification_spool
+                        SET status=%s, next_attempt=NULL, attempts=%s, last_error=%s
+                        WHERE id=%s AND next_attempt=%s AND status=%s""",
+                        (DEAD, attempts, 'delivery interrupted', id, next_attempt, status))
+                    continue
+                cursor.execute("""
+                    UPDATE por_notification_spool SET status=%s, next_attempt=%s, attempts=%s
+                    WHERE id=%s AND next_attempt=%s AND status=%s""",
+                    (SENDING, now + self.lease, attempts, id, next_attempt, status))
+                if cursor.rowcount == 1: # not taken by another worker in the meantime
+                    claimed.append((id, json.loads(payload), attempts))
+        return claimed
+
+    def _deliver(self, claimed, template_name, message):
+        ids = [id for id, payload, attempts in claimed]
+        try:
+            self.transport.send_template(template_name, message)
+        except Exception, e:
+            error = exception_to_unicode(e)
+            updates = []
+            for id, payload, attempts in claimed:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    status, next_attempt = DEAD, None
+                    self.log.error("Notification %s dropped after %s attempts: %s",
+                                   id, attempts, error)
+                else:
+                    status = QUEUED
+                    next_attempt = int(time.time()) + self.retry_delay * 2 ** (attempts - 1)
+                    self.log.warning("Notification %s not delivered (attempt %s): %s",
+                                     id, attempts, error)
+                updates.append((status, next_attempt, attempts, error, id))
+
+            @self.env.with_transaction()
+            def do_fail(db):
+                cursor = db.cursor()
+                cursor.executemany("""
+                    UPDATE por_notification_spool
+                    SET status=%s, next_attempt=%s, attempts=%s, last_error=%s
+                    WHERE id=%s""", updates)
+        else:
+            @self.env.with_transaction()
+            def do_delete(db):
+                cursor = db.cursor()
+                cursor.executemany("DELETE FROM por_notification_spool WHERE id=%s",
+                                   [(id,) for id in ids])
+
+
+class SpoolWorkers(object):
+    """Threads delivering the spool of an environment.
+
+    Only a weak reference to the environment is kept: the threads stop when
+    it is shut down or garbage collected."""
+
+    def __init__(self, env, count, poll_interval):
+        self._env = weakref.ref(env)
+        self.path = env.path
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.threads = []
+        for i in range(count):
+            thread = threading.Thread(target=self.run, name='por-notification-%d' % i)
+            thread.setDaemon(True)
+            self.threads.append(thread)
+
+    @property
+    def env(self):
+        return self._env()
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            env = self.env
+            if env is None or self.stopped:
+                break
+            try:
+                NotificationSpool(env).deliver_pending()
+            except Exception, e:
+                env.log.error("Notification spool: %s", exception_to_unicode(e, traceback=True))
+            del env
+
+
+def start_workers(env, count, poll_interval):
+    """Start the delivery threads of `env`, unless a live environment of
+    the same path already has them."""
+    with _workers_lock:
+        workers = _workers.get(env.path)
+        if workers is not None and workers.env is not None:
+            return workers
+        if workers is not None:
+            workers.stop()
+        workers = _workers[env.path] = SpoolWorkers(env, count, poll_interval)
+        workers.start()
+        return workers
+
+
+def stop_workers(env):
+    """Stop the delivery threads owned by `env`, e.g. when it is shut down."""
+    with _workers_lock:
+        workers = _workers.get(env.path)
+        if workers is not None and workers.env in (env, None):
+            del _workers[env.path]
+            workers.stop()
+        return workers
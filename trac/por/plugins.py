@@ -1,25 +1,26 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import hashlib
 import json
-import operator
 import pkg_resources
 import re
+import threading
+import time
 import urllib
-import mandrill
-import sqlalchemy.orm.exc
 
 from pytz import timezone
+from sqlalchemy import func
 from genshi.builder import tag
 from genshi.core import TEXT
 from genshi.output import TextSerializer
 from genshi.filters.transform import Transformer
 
 from creole.rest2html.clean_writer import rest2html
+from trac.cache import cached
 from trac.config import IntOption, Option
 from trac.core import Component
 from trac.core import implements
-from trac.resource import Resource
 from trac.ticket import query
 from trac.wiki.formatter import format_to_html
 from trac.test import Mock, MockPerm
@@ -27,22 +28,29 @@ from trac.web.href import Href
 from trac.mimeview import Context
 from themeengine.api import ThemeBase
 from tracrpc.api import IXMLRPCHandler
-from trac.ticket.model import Milestone
-from trac.web.api import IRequestFilter, ITemplateStreamFilter, IRequestHandler
-from trac.ticket.api import TicketSystem
+from trac.web.api import IRequestFilter, ITemplateStreamFilter, IRequestHandler, RequestDone
+from trac.ticket.api import IMilestoneChangeListener, ITicketChangeListener, TicketSystem
 from trac.web.chrome import ITemplateProvider, add_script, add_script_data, add_stylesheet, Chrome
 from trac.ticket.web_ui import TicketModule
 from trac.notification import IEmailSender
+from trac.util import Ranges
+from trac.util.datefmt import from_utimestamp
+from trac.util.text import to_unicode
 
 from penelope.core.fanstatic_resources import dashboard
 from penelope.core.fanstatic_resources import add_entry_from_ticket
 from penelope.core.models import DBSession
-from penelope.core.models.dashboard import CustomerRequest, Project, User
+from penelope.core.models.dashboard import CustomerRequest
 from penelope.core.models.tp import TimeEntry
 from penelope.core.models.tp import timedelta_as_human_str
 from genshi import Markup
 
+from trac.por.cache import LRUCache, cache_stats, get_generation
+from trac.por.context import get_context, short_lived_session
 from trac.por.i18n import add_domains
+from trac.por.notification import NotificationSpool
+from trac.por.ticketindex import TicketIndex
+from trac.por.user import PERMISSION_TOPICS, permission_cache, viewable_tickets
 
 
 
@@ -84,16 +92,16 @@ class PorNav(Component):
     # TODO: cache
     # TODO: c'è un metodo per ricavare le url del customer e del project?
     def filter_stream(self, req, method, filename, stream, data):
-        project_id = self.env.config.get('por-dashboard', 'project-id')
-        if project_id:
-            project = DBSession().query(Project).get(project_id)
+        context = get_context(self.env)
+        if context:
+            project, customer = context.project, context.customer
             # XXX se project is None, 404
 
             stream |= Transformer(".//div[@id='trac-before-subnav']").prepend(tag.ul(
                     tag.li(tag.a("Home", href="/")),
                     tag.li(
                             tag.span(" / ", class_="divider"),
-                            tag.a(project.customer.name, href="/admin/Customer/%s" % project.customer.id)
+                            tag.a(customer.name, href="/admin/Customer/%s" % customer.id)
                         ),
                     tag.li(
                             tag.span(" / ", class_="divider"),
@@ -170,7 +178,8 @@ class PorTimeEntry(Component):
 
     def post_process_request(self, req, template, data, content_type):
         if template == 'ticket.html' and req.perm.has_permission('TIME_ENTRY_ADD'):
-            cr = DBSession().query(CustomerRequest).get(data['ticket'].values['customerrequest'])
+            context = get_context(self.env)
+            cr = context and context.get_customer_request(data['ticket'].values['customerrequest'])
             if cr and cr.workflow_state in ['created', 'estimated']:
                 add_entry_from_ticket.need()
         return template, data, content_type
@@ -230,7 +239,23 @@ class PorTicketTimeEntries(Component):
     """
     Render ticket timeentries
     """
-    implements(IRequestFilter)
+    implements(IRequestFilter, IRequestHandler)
+
+    page_size = 20
+
+    def time_entries(self, project_id, ticket_id, *entities):
+        """
+        Query on the time entries of the ticket, most recent first unless
+        other `entities` (e.g. aggregates) are requested.
+        """
+        qry = DBSession().query(*(entities or (TimeEntry,)))\
+                         .filter(TimeEntry.project_id == project_id)\
+                         .filter(TimeEntry.ticket == ticket_id)
+        if not entities:
+            qry = qry.order_by(TimeEntry.date.desc(),
+                               TimeEntry.modification_date.desc(),
+                               TimeEntry.id.desc())
+        return qry
 
     # IRequestFilter methods
     def pre_process_request(self, req, handler):
@@ -243,20 +268,53 @@ class PorTicketTimeEntries(Component):
             project_id = self.env.config.get('por-dashboard', 'project-id')
             ticket_id = req.args.get('id', None)
             if ticket_id and project_id:
-                timeentries = DBSession().query(TimeEntry)\
-                               .filter_by(project_id=project_id)\
-                               .filter_by(ticket=int(ticket_id)).order_by(TimeEntry.date.desc(), TimeEntry.modification_date.desc())
-                delta = datetime.timedelta()
-                delta_tot = sum([e.hours for e in timeentries], delta)
-                req.ticket_time_entries_total = timedelta_as_human_str(delta_tot)
-                req.ticket_time_entries = timeentries[:20]
-                req.ticket_time_entries_count = timeentries.count()
+                count, delta_tot = self.time_entries(project_id, int(ticket_id),
+                                                     func.count(TimeEntry.id),
+                                                     func.sum(TimeEntry.hours)).one()
+                req.ticket_time_entries_total = timedelta_as_human_str(delta_tot or datetime.timedelta())
+                req.ticket_time_entries_count = count
+                if count:
+                    req.ticket_time_entries = self.time_entries(project_id, int(ticket_id))\
+                                                  .limit(self.page_size).all()
 
         return handler
 
     def post_process_request(self, req, template, data, content_type):
         return template, data, content_type
 
+    # IRequestHandler methods
+    def match_request(self, req):
+        match = re.match(r'/ticket_time_entries/(\d+)$', req.path_info)
+        if match:
+            req.args['id'] = match.group(1)
+            return True
+
+    def process_request(self, req):
+        """
+        Returns a JSON page of the ticket time entries, starting from `offset`.
+        """
+        ticket_id = int(req.args['id'])
+        req.perm('ticket', ticket_id).require('TICKET_ADMIN')
+        project_id = self.env.config.get('por-dashboard', 'project-id')
+        try:
+            offset = max(int(req.args.get('offset', self.page_size)), 0)
+        except ValueError:
+            offset = self.page_size
+        timeentries = self.time_entries(project_id, ticket_id)\
+                          .offset(offset).limit(self.page_size + 1).all()
+        more = len(timeentries) > self.page_size
+        page = {
+            'entries': [{'id': te.id,
+                         'date': unicode(te.date),
+                         'description': te.description,
+                         'author': unicode(te.author),
+                         'hours': te.hours_str,
+                         'href': '/admin/TimeEntry/%s' % te.id}
+                        for te in timeentries[:self.page_size]],
+            'next_offset': more and offset + self.page_size or None,
+        }
+        req.send(json.dumps(page), 'application/json')
+
 
 class PorReportDropDown(Component):
     """
@@ -307,21 +365,87 @@ class PorUserEmailLookup(Component):
     """
     implements(ITemplateStreamFilter)
 
-    def email_lookup(self, text):
+    owner_options = "//select[@id='action_review_reassign_owner' or " \
+                             "@id='action_reassign_reassign_owner' or " \
+                             "@name='0_owner' or @name='field_owner']/option"
+
+    def email_lookup(self, fullnames, text):
         try:
-            user = DBSession.query(User).filter(User.email==text).one()
-            return user.fullname
-        except sqlalchemy.orm.exc.NoResultFound:
-            return text
+            return fullnames[text]
+        except KeyError:
+            # not a project member: fall back to the request identity map
+            context = get_context(self.env)
+            user = context and context.get_user(text)
+            fullname = user and user.fullname or text
+            return fullnames.setdefault(text, fullname)
 
     def filter_stream(self, req, method, filename, stream, data):
-        stream |= Transformer("//select[@id='action_review_reassign_owner']/option").map(self.email_lookup, TEXT)
-        stream |= Transformer("//select[@id='action_reassign_reassign_owner']/option").map(self.email_lookup, TEXT)
-        stream |= Transformer("//select[@name='0_owner']/option").map(self.email_lookup, TEXT)
-        stream |= Transformer("//select[@name='field_owner']/option").map(self.email_lookup, TEXT)
+        # the known users are loaded at the first owner option, most of
+        # the rendered pages have none
+        fullnames = []
+        def lookup(text):
+            if not fullnames:
+                fullnames.append(dict([(email, fullname) for login, fullname, email
+                                       in self.env.get_known_users()]))
+            return self.email_lookup(fullnames[0], text)
+        stream |= Transformer(self.owner_options).map(lookup, TEXT)
         return stream
 
 
+def id_prefix_ranges(prefix, max_id, min_id=1):
+    """
+    Return the (start, end) ranges of the ticket ids between `min_id` and
+    `max_id` starting with the digits of `prefix`, e.g. 12, 120-129,
+    1200-1299 and so on.
+    """
+    if not prefix.isdigit() or prefix.startswith('0'):
+        return []
+    ranges = []
+    start = end = int(prefix)
+    while start <= max_id:
+        if end >= min_id:
+            ranges.append((max(start, min_id), min(end, max_id)))
+        start, end = start * 10, end * 10 + 9
+    return ranges
+
+
+def format_id_ranges(ranges):
+    """
+    Format (start, end) ranges in trac query syntax, e.g. 12,120-129
+    """
+    return ','.join([start == end and str(start) or '%d-%d' % (start, end)
+                     for start, end in ranges])
+
+
+def parse_id_ranges(value):
+    """
+    Parse the value of an id= query condition, e.g. 1-5,8|12, to sorted
+    (start, end) ranges.
+    """
+    ranges = Ranges()
+    for r in query.Query._item_splitter.split(value):
+        try:
+            ranges.appendrange(r)
+        except ValueError:
+            raise query.QuerySyntaxError('Invalid ticket id list: %s' % r)
+    return ranges.pairs
+
+
+def intersect_id_ranges(ranges, others):
+    """
+    Return the (start, end) ranges of the ids both in `ranges` and in
+    `others` (sorted, non overlapping ranges).
+    """
+    out = []
+    for start, end in ranges:
+        for other_start, other_end in others:
+            if other_start > end:
+                break
+            if other_end >= start:
+                out.append((max(start, other_start), min(end, other_end)))
+    return out
+
+
 class TicketRPC(Component):
     """ An interface to Trac's ticketing system. """
 
@@ -332,91 +456,176 @@ class TicketRPC(Component):
         return 'ticket'
 
     def xmlrpc_methods(self):
-        yield (None, ((list,), (list, str)), self.queryWithDetails)
-        yield (None, ((list,), (list, str)), self.queryCustomerRequestsByTicktes)
+        yield (None, ((list,), (list, str), (list, str, list)), self.queryWithDetails)
+        yield (None, ((dict,), (dict, str), (dict, str, list), (dict, str, list, str),
+                      (dict, str, list, str, int)), self.queryWithDetailsCursor)
+        yield (None, ((list, list), (dict, list, bool)), self.queryCustomerRequestsByTicktes)
         yield (None, ((list,), (list, str)), self.queryAllCustomerRequests)
+        yield (None, ((dict,), (dict, str)), self.queryChangesSince)
 
     # Exported methods
-    def queryWithDetails(self, req, qstr='status!=closed'):
+    def queryWithDetails(self, req, qstr='status!=closed', fields=None):
         """
         Perform a ticket query, returning a list of ticket dictionaries.
         All queries will use stored settings for maximum number of results per
         page and paging options. Use `max=n` to define number of results to
         receive, and use `page=n` to page through larger result sets. Using
         `max=0` will turn off paging and return all results.
+        `fields` restricts the ticket dictionaries to the given keys, e.g.
+        ['id', 'summary', 'status', 'cr'].
         """
-        # TODO: gestione custom id^= (workaround)
-        if "id^=" in qstr:
-            startswith = re.search('id\^=([\d]*)', qstr).group(1)
-            qstr = re.sub('id\^=[\d]*', '', qstr)
-            qstr = re.sub('^&|&$|&&', '', qstr)
-            if "max=" in qstr:
-                limit = re.search('max=([\d]*)', qstr).group(1)
-                qstr = re.sub('max=[\d]*', 'max=0', qstr)
-            else:
-                limit = None
-        else:
-            startswith = None
-            limit = None
+        qstr = self._prepare_query(qstr)
+        if qstr is None:
+            return []
+        return self._query_details(req, qstr, fields)[0]
 
-        q = query.Query.from_string(self.env, qstr)
-        ticket_realm = Resource('ticket')
-        out = []
-        for t in q.execute(req):
-            tid = t['id']
-            if not startswith or str(tid).startswith(startswith):
-                if 'TICKET_VIEW' in req.perm(ticket_realm(id=tid)):
-                    out.append(t)
-                    if limit and len(out) >= limit:
-                        break
-
-        # fill 'resolution' value (it is not provided by the above query)
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("SELECT id, resolution FROM ticket WHERE status='closed'")
-        
-        resolution = {}
-        for row in cursor:
-            resolution[row[0]] = row[1]
-
-        # fill 'sensitive' value (TODO optimize, as it now retrieves all tickets)
-        db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("SELECT ticket, value FROM ticket_custom WHERE name='sensitive' AND value='1'")
-        sensitive = set()
-        for row in cursor:
-            sensitive.add(row[0])
-
-        # fill 'customerrequest' value (TODO optimize, as it now retrieves all tickets)
-        cursor = db.cursor()
-        cursor.execute("SELECT t.id AS ticket, c.value FROM ticket t INNER JOIN ticket_custom c ON (t.id = c.ticket AND c.name = 'customerrequest') order by ticket")
-        cr= {}
-        for row in cursor:
-            cr[row[0]]=row[1]
-
-        for t in out:
-            t['sensitive'] = int(t['id'] in sensitive)
-            t['resolution'] = resolution.get(t['id'], '')
-            t['cr'] = cr.get(t['id'], '')
+    def queryWithDetailsCursor(self, req, qstr='status!=closed', fields=None,
+                               cursor='', size=1000):
+        """
+        Perform a ticket query like queryWithDetails, returning at most
+        `size` tickets, ordered by id, after the given `cursor` (order, max
+        and page arguments of the query are ignored)::
 
-        return out
+            {'tickets': ticket dictionaries,
+             'cursor': cursor for the next call, '' after the last ticket}
 
-    def queryCustomerRequestsByTicktes(self, req, ticket_ids):
+        Large result sets can be fetched chunk by chunk, without building
+        them in memory at once. The cursor is intersected with the id=
+        conditions of the query, if any.
+        """
+        size = max(int(size), 1)
+        qstr = '&'.join([arg for arg in qstr.split('&') if arg and
+                         arg.split('=')[0] not in ('order', 'desc', 'max', 'page')])
+        qstr = self._prepare_query(qstr, after=int(cursor or 0))
+        if qstr is None:
+            return {'tickets': [], 'cursor': ''}
+        qstr = '&'.join(filter(None, [qstr, 'order=id&max=%d' % size]))
+        out, tickets = self._query_details(req, qstr, fields)
+        return {
+            'tickets': out,
+            'cursor': len(tickets) == size and str(tickets[-1]['id']) or '',
+        }
+
+    def queryChangesSince(self, req, since='0'):
+        """
+        Return what changed after the `since` watermark, as returned by the
+        previous call ('0' the first time)::
+
+            {'watermark': watermark for the next call,
+             'tickets': changed tickets, as returned by queryWithDetails,
+             'customerrequests': [[ticket_id, customerrequest_field], ...],
+             'sensitive': [[ticket_id, 0 or 1], ...],
+             'deleted': ids of the deleted tickets}
+
+        Tickets changed in the last few seconds may be returned again by
+        the next call. Deleted tickets are kept for 30 days: a client whose
+        watermark is older must start over from '0'.
+        """
+        ticket_index = TicketIndex(self.env)
+        rows, deleted, watermark = ticket_index.changes_since(int(since or 0))
+        index = dict([(row['ticket'], row) for row in rows])
+        ids = sorted(viewable_tickets(self.env, req, index.keys(), index))
+        tickets = []
+        for start in range(0, len(ids), ticket_index.chunk_size):
+            chunk = ids[start:start + ticket_index.chunk_size]
+            q = query.Query.from_string(self.env, 'max=0&order=id&id=%s' %
+                                        ','.join([str(id) for id in chunk]))
+            tickets.extend(q.execute(req))
+        self._fill_details(tickets, index)
+        return {
+            'watermark': str(watermark),
+            'tickets': tickets,
+            'customerrequests': [[id, index[id]['customerrequest']] for id in ids
+                                 if index[id]['customerrequest'] is not None],
+            'sensitive': [[id, index[id]['sensitive']] for id in ids],
+            'deleted': deleted,
+        }
+
+    def _prepare_query(self, qstr, after=None):
+        """
+        Translate the id^= conditions of `qstr` (not supported by trac
+        queries) to id ranges, optionally restricted to the ids greater
+        than `after`. The ranges are intersected with the id= conditions
+        of the query, that trac would OR with them instead. Return None if
+        no ticket can match.
+        """
+        clauses = [[]]
+        for arg in query.Query._clause_splitter.split(qstr):
+            if arg == 'or':
+                clauses.append([])
+            elif arg:
+                clauses[-1].append(arg)
+        max_id = None
+        out = []
+        for args in clauses:
+            prefixes = [arg[4:] for arg in args if arg.startswith('id^=')]
+            args = [arg for arg in args if not arg.startswith('id^=')]
+            if filter(None, prefixes) or after is not None:
+                if max_id is None:
+                    db = self.env.get_db_cnx()
+                    cursor = db.cursor()
+                    cursor.execute("SELECT MAX(id) FROM ticket")
+                    max_id = cursor.fetchone()[0] or 0
+                min_id = (after or 0) + 1
+                ranges = min_id <= max_id and [(min_id, max_id)] or []
+                for prefix in filter(None, prefixes):
+                    ranges = intersect_id_ranges(ranges, id_prefix_ranges(prefix, max_id))
+                ids = [arg[3:] for arg in args if arg.startswith('id=')]
+                if ids:
+                    ranges = intersect_id_ranges(ranges, parse_id_ranges('|'.join(ids)))
+                    args = [arg for arg in args if not arg.startswith('id=')]
+                if not ranges:
+                    continue
+                args.append('id=' + format_id_ranges(ranges))
+            out.append('&'.join(args))
+        if not out:
+            return None
+        return '&or&'.join(out)
+
+    def _query_details(self, req, qstr, fields=None):
+        """
+        Execute the query, return the viewable tickets with their details
+        (projected to `fields`) and the tickets returned by the query.
+        """
+        if fields:
+            names = [f['name'] for f in TicketSystem(self.env).get_ticket_fields()]
+            qstr += ''.join(['&col=%s' % f for f in fields if f in names])
+        q = query.Query.from_string(self.env, qstr)
+        tickets = q.execute(req)
+        index = TicketIndex(self.env).lookup([t['id'] for t in tickets])
+        viewable = viewable_tickets(self.env, req, [t['id'] for t in tickets], index)
+        out = [t for t in tickets if t['id'] in viewable]
+        self._fill_details(out, index)
+        if fields:
+            out = [dict([(f, t[f]) for f in fields if f in t]) for t in out]
+        return out, tickets
+
+    def _fill_details(self, tickets, index):
+        # fill 'resolution', 'sensitive' and 'customerrequest' values (they
+        # are not provided by trac queries)
+        for t in tickets:
+            row = index.get(t['id'], {})
+            t['sensitive'] = row.get('sensitive') or 0
+            t['resolution'] = row.get('status') == 'closed' and row.get('resolution') or ''
+            t['cr'] = row.get('customerrequest') or ''
+
+    def queryCustomerRequestsByTicktes(self, req, ticket_ids, mapping=False):
         """
             Args:
                 ticket_ids: list of ticket ids
+                mapping: return a dict instead of a list
 
             Returns:
                 list of tuples: ticket_id, customerrequest_field ('id> description')
+                with mapping: dict {'ticket_id': customerrequest_field}
         """
         db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("""SELECT ticket, value FROM ticket_custom
-            WHERE name='customerrequest' AND ticket IN %(tickets)s;""",
-                {'tickets': tuple(ticket_ids)})
-        customer_request_ids = cursor.fetchall() or []
+        customer_requests = TicketIndex(self.env).customer_requests(ticket_ids, db=db)
         db.rollback()
-        return customer_request_ids
+        if mapping:
+            # XML-RPC struct keys are strings
+            return dict([(str(ticket), cr) for ticket, cr in customer_requests.items()])
+        return sorted(customer_requests.items())
 
     def queryAllCustomerRequests(self, req):
         """
@@ -427,11 +636,9 @@ class TicketRPC(Component):
                 list of tuples: ticket_id, customerrequest_field
         """
         db = self.env.get_db_cnx()
-        cursor = db.cursor()
-        cursor.execute("SELECT ticket, value FROM ticket_custom WHERE name='customerrequest'")
-        rows = cursor.fetchall() or []
+        rows = TicketIndex(self.env).query("customerrequest IS NOT NULL", db=db)
         db.rollback()
-        return rows
+        return [(row['ticket'], row['customerrequest']) for row in rows]
 
 
 class CustomerTicketsPolicy(Component):
@@ -525,55 +732,188 @@ class SensitiveTicketsPolicy(Component):
 
 
 
+# outstanding tickets JSON by (trac environment, user, base url)
+outstanding_cache = LRUCache(maxsize=1024, name='outstanding_tickets')
+
+
 class OutstandingTickets(Component):
     """
     Returns a JSON object with info about open tickets.
+
+    /outstanding_tickets/changes?version=<version>&timeout=<seconds> waits
+    until the outstanding tickets differ from the given `version` (as found
+    in the JSON object), returning them, or answers 204 No Content when the
+    timeout expires (immediately if no timeout is given).
     """
-    implements(IRequestHandler)
+    implements(IRequestHandler, ITicketChangeListener)
+
+    longpoll_timeout = IntOption('por-dashboard', 'outstanding_longpoll_timeout', 60,
+        """Maximum number of seconds a request for the outstanding tickets
+        changes is held waiting for a change. Every waiting request holds a
+        server thread until then (its penelope lookups use short-lived
+        sessions): size the server threads for the number of open
+        dashboards, or lower the timeout.""")
+
+    recheck_interval = 5 # seconds, for the changes made by other processes
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._change_count = 0
 
     def match_request(self, req):
         match = re.match(r'/outstanding_tickets/', req.path_info)
         if match:
             return True
 
+    # ITicketChangeListener methods
+    def ticket_created(self, ticket):
+        self._notify()
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        self._notify()
 
-    def iter_tickets(self, req, query_string):
-        q = query.Query.from_string(self.env, query_string)
-        ticket_realm = Resource('ticket')
-        for t in sorted(q.execute(req), key=operator.itemgetter('changetime'), reverse=True):
-            if 'TICKET_VIEW' in req.perm(ticket_realm(id=t['id'])):
-                yield {
-                    'id': t['id'],
-                    'summary': t['summary'],
-                    'status': t['status'],
-                    'priority_value': t['priority_value'],
-                    'href': t['href'],
-                    }
+    def ticket_deleted(self, ticket):
+        self._notify()
+
+    def _notify(self):
+        with self._changed:
+            self._change_count += 1
+            self._changed.notify_all()
+
+
+    statuses = ('accepted', 'assigned', 'new', 'reopened', 'reviewing')
+
+    def query_outstanding(self, req, limit=None):
+        """
+        Return the open tickets owned by the user and the unassigned ones,
+        most recently changed first, at most `limit` of each.
+        """
+        columns = "t.id, t.summary, t.status, COALESCE(t.owner,''), p.value, t.changetime"
+        tables = "ticket t LEFT OUTER JOIN enum p ON (p.type='priority' AND p.name=t.priority)"
+        statuses = ','.join(['%s'] * len(self.statuses))
+        def select(owner_condition):
+            return "SELECT %s FROM %s WHERE %s AND t.status IN (%s) " \
+                   "ORDER BY t.changetime DESC, t.id" % (columns, tables, owner_condition, statuses)
+        if limit:
+            # the latest `limit` tickets of each list, still a single statement
+            sql = "SELECT * FROM (%s LIMIT %d) own UNION ALL " \
+                  "SELECT * FROM (%s LIMIT %d) unassigned ORDER BY 6 DESC, 1" % (
+                      select("t.owner=%s"), limit, select("COALESCE(t.owner,'')=''"), limit)
+            args = [req.authname] + list(self.statuses) * 2
+        else:
+            sql = select("COALESCE(t.owner,'') IN (%s,'')")
+            args = [req.authname] + list(self.statuses)
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute(sql, args)
+        rows = cursor.fetchall()
+
+        viewable = viewable_tickets(self.env, req, [row[0] for row in rows])
+        tickets_own, tickets_unassigned = [], []
+        for id, summary, status, owner, priority_value, changetime in rows:
+            if id not in viewable:
+                continue
+            ticket = {
+                'id': id,
+                'summary': summary,
+                'status': status,
+                'priority_value': priority_value,
+                'href': req.href.ticket(id),
+                }
+            if owner:
+                tickets_own.append(ticket)
+            else:
+                tickets_unassigned.append(ticket)
+        return tickets_own, tickets_unassigned
 
     def process_request(self, req):
-        qs = (
-            'owner=%s'
-            '&max=0'
-            '&status=accepted'
-            '&status=assigned'
-            '&status=new'
-            '&status=reopened'
-            '&status=reviewing'
-            )
+        try:
+            limit = max(int(req.args.get('limit') or 0), 0) or None
+        except ValueError:
+            limit = None
+        if req.path_info.startswith('/outstanding_tickets/changes'):
+            self.wait_changes(req, limit)
+        version = self.version(req, limit)
+        req.check_modified(from_utimestamp(max(version[0])), version)
+        data, token = self.get_outstanding(req, limit, version)
+        req.send(data, 'application/json')
 
+    def wait_changes(self, req, limit):
+        try:
+            timeout = min(max(int(req.args.get('timeout') or 0), 0), self.longpoll_timeout)
+        except ValueError:
+            timeout = 0
+        deadline = time.time() + timeout
+        while True:
+            with self._changed:
+                change_count = self._change_count
+            # the penelope lookups of the permission checks use a session
+            # closed before waiting, the request one is left alone
+            with short_lived_session():
+                data, token = self.get_outstanding(req, limit, self.version(req, limit))
+            if token != req.args.get('version'):
+                req.send(data, 'application/json')
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            with self._changed:
+                if change_count == self._change_count:
+                    self._changed.wait(min(remaining, self.recheck_interval))
+        req.send_response(204)
+        req.send_header('Content-Length', 0)
+        req.end_headers()
+        raise RequestDone
+
+    def version(self, req, limit):
+        # the tickets and the user permissions the result depends on, as
+        # seen by every process: the index watermark moves with any ticket
+        # change. The permission generations are local to the process, like
+        # the permission cache they expire after its ttl
+        return [TicketIndex(self.env).watermark(),
+                get_generation(*PERMISSION_TOPICS),
+                int(time.time() // permission_cache.ttl),
+                req.base_url, limit]
+
+    def get_outstanding(self, req, limit, version):
+        """
+        Return the outstanding tickets JSON of the user and its version.
+        """
+        return outstanding_cache.get((self.env.path, req.authname, req.base_url, limit),
+                                     lambda: self.outstanding_tickets(req, limit),
+                                     generation=repr(version))
+
+    def outstanding_tickets(self, req, limit=None):
+        qs = '&'.join(['owner=%s', 'max=0'] + ['status=%s' % status for status in self.statuses])
         qs_own = qs % req.authname
         qs_unassigned = qs % ''
 
-        tickets_own = list(self.iter_tickets(req, query_string=qs_own))
-        tickets_unassigned = list(self.iter_tickets(req, query_string=qs_unassigned))
+        tickets_own, tickets_unassigned = self.query_outstanding(req, limit)
+        token = hashlib.sha1(json.dumps([tickets_own, tickets_unassigned])).hexdigest()
 
         data = json.dumps({
                     'tickets_own': tickets_own,
                     'query_url_own': '%s/query?%s' % (req.base_url, qs_own),
                     'tickets_unassigned': tickets_unassigned,
                     'query_url_unassigned': '%s/query?%s' % (req.base_url, qs_unassigned),
+                    'version': token,
                     })
-        req.send(data, 'application/json')
+        return data, token
+
+
+
+class PorCacheStats(Component):
+    """
+    Returns a JSON object with hit/miss counters of the trac.por caches.
+    """
+    implements(IRequestHandler)
+
+    def match_request(self, req):
+        match = re.match(r'/por_cache_stats$', req.path_info)
+        if match:
+            return True
+
+    def process_request(self, req):
+        req.perm.require('TRAC_ADMIN')
+        req.send(json.dumps(cache_stats()), 'application/json')
 
 
 
@@ -616,25 +956,48 @@ class MilestoneEnhacement(Component):
     """
     Add milestone due date to selection
     """
-    implements(ITemplateStreamFilter)
-
-    def duedate_lookup(self, text):
-        milestone = Milestone(self.env, text)
-        if milestone.due:
-            tzname = self.env.config.get('trac', 'default_timezone')
-            if tzname:
-                tz = timezone(tzname)
-                due = milestone.due.astimezone(tz)
-            else:
-                due = milestone.due
-            text += ' [%s]' % due.strftime('%Y-%m-%d')
+    implements(ITemplateStreamFilter, IMilestoneChangeListener)
+
+    @cached
+    def milestone_duedates(self, db):
+        """Formatted due date of the milestones, by name"""
+        tzname = self.env.config.get('trac', 'default_timezone')
+        tz = tzname and timezone(tzname) or None
+        duedates = {}
+        cursor = db.cursor()
+        cursor.execute("SELECT name, due FROM milestone WHERE due IS NOT NULL AND due != 0")
+        for name, due in cursor:
+            due = from_utimestamp(due)
+            if tz:
+                due = due.astimezone(tz)
+            duedates[name] = due.strftime('%Y-%m-%d')
+        return duedates
+
+    def duedate_lookup(self, duedates, text):
+        if text in duedates:
+            text += ' [%s]' % duedates[text]
         return text
 
     def filter_stream(self, req, method, filename, stream, data):
-        stream |= Transformer("//select[@id='field-milestone']/optgroup/option").map(self.duedate_lookup, TEXT)
-        stream |= Transformer("//a[@class='milestone']").map(self.duedate_lookup, TEXT)
+        duedates = self.milestone_duedates
+        lookup = lambda text: self.duedate_lookup(duedates, text)
+        stream |= Transformer("//select[@id='field-milestone']/optgroup/option | "
+                              "//a[@class='milestone']").map(lookup, TEXT)
         return stream
 
+    # IMilestoneChangeListener methods
+    def milestone_created(self, milestone):
+        del self.milestone_duedates
+
+    def milestone_changed(self, milestone, old_values):
+        del self.milestone_duedates
+
+    def milestone_deleted(self, milestone):
+        del self.milestone_duedates
+
+
+# rendered notification bodies: descriptions are sent again at every change
+rendering_cache = LRUCache(maxsize=512, name='notification_html')
 
 
 class MandrillEmailSender(Component):
@@ -652,20 +1015,43 @@ class MandrillEmailSender(Component):
     smtp_password = Option('notification', 'smtp_password', '',
         """Password for SMTP server. (''since 0.9'')""")
 
+    def __init__(self):
+        self._wiki_context = None
+
+    @property
+    def wiki_context(self):
+        """ Anonymous rendering context, built once """
+        if self._wiki_context is None:
+            req = Mock(href=Href(self.env.abs_href.base),
+                       abs_href=self.env.abs_href,
+                       authname='anonymous',
+                       perm=MockPerm(),
+                       args={})
+            self._wiki_context = Context.from_request(req, 'wiki')
+        return self._wiki_context
+
+    def render_cached(self, kind, text, render):
+        """ Memoize `render(text)`, by content and trac environment """
+        if not text:
+            return render(text)
+        key = (self.env.path, self.env.abs_href.base, kind,
+               hashlib.sha1(to_unicode(text).encode('utf8')).hexdigest())
+        return rendering_cache.get(key, lambda: render(text))
+
     def wiki2html(self, wiki):
         """ The easiest way to convert wiki to html """
-        req = Mock(href=Href(self.env.abs_href.base),
-                   abs_href=self.env.abs_href,
-                   authname='anonymous',
-                   perm=MockPerm(),
-                   args={})
-        context = Context.from_request(req, 'wiki')
+        return self.render_cached('wiki', wiki, self._wiki2html)
+
+    def _wiki2html(self, wiki):
         try:
-            html = format_to_html(self.env, context, wiki).encode('utf8','ignore')
+            html = format_to_html(self.env, self.wiki_context, wiki).encode('utf8','ignore')
         except AttributeError:
             html = wiki
         return html
 
+    def rest2html(self, rest):
+        return self.render_cached('rest', rest, rest2html)
+
     def send(self, from_addr, recipients, data):
         # Ensure the message complies with RFC2822: use CRLF line endings
         message = data['msg']
@@ -674,7 +1060,7 @@ class MandrillEmailSender(Component):
         params = {}
         changes_body = data['changes_body']
         if changes_body:
-            params['changes_body'] = rest2html(changes_body)
+            params['changes_body'] = self.rest2html(changes_body)
 
         if data['ticket']['new']:
             params['ticket_new'] = True
@@ -697,7 +1083,6 @@ class MandrillEmailSender(Component):
         for k,v in params.items():
             merged_params.append({'name': k, 'content':v})
 
-        mandrill_client = mandrill.Mandrill(self.smtp_password)
         message = {'auto_html': None,
                    'auto_text': None,
                    'from_email': from_addr,
@@ -712,9 +1097,8 @@ class MandrillEmailSender(Component):
         for rec in recipients:
             message['to'].append({'email':rec})
 
-        self.log.info("Sending notification through Mandril API to %s"
+        self.log.info("Queueing notification through Mandril API to %s"
                       % recipients)
 
-        mandrill_client.messages.send_template(template_name='ticket',
-                                               template_content=[],
-                                               message=message)
+        NotificationSpool(self.env).enqueue('ticket', message,
+                                            ticket=data['ticket']['link'])
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Mandrill delivery benchmark against a local fake endpoint.
+
+Compares the former delivery (a new client, hence a new HTTP connection,
+and one API call per notification) with the spool delivery (a long-lived
+client and batched send_template calls)::
+
+    python -m trac.por.tests.bench_mandrill [messages] [latency ms]
+"""
+
+import json
+import sys
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import mandrill
+
+from trac.por.notification import batch_messages
+
+
+class FakeMandrillHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    latency = 0.0
+    calls = 0
+
+    def do_POST(self):
+        FakeMandrillHandler.calls += 1
+        params = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.latency)
+        body = json.dumps([{'email': to['email'], 'status': 'sent'}
+                           for to in params['message']['to']])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeMandrillServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_messages(count):
+    return [('ticket', {'from_email': 'trac@example.org',
+                        'subject': u'#%d: Foo' % i,
+                        'global_merge_vars': [{'name': 'ticket_link', 'content': '/ticket/%d' % i}],
+                        'to': [{'email': 'user%d@example.org' % i}]})
+            for i in range(count)]
+
+
+def before(messages):
+    for template_name, message in messages:
+        client = mandrill.Mandrill('fake-key')
+        client.messages.send_template(template_name=template_name,
+                                      template_content=[], message=message)
+
+
+def after(messages, batch_size=20):
+    client = mandrill.Mandrill('fake-key')
+    for start in range(0, len(messages), batch_size):
+        for indexes, template_name, message in batch_messages(messages[start:start + batch_size]):
+            client.messages.send_template(template_name=template_name,
+                                          template_content=[], message=message)
+
+
+def run(name, delivery, messages):
+    FakeMandrillHandler.calls = 0
+    start = time.time()
+    delivery(messages)
+    elapsed = time.time() - start
+    print '%-8s %6d messages %5d calls %8.1f messages/s' % (
+        name, len(messages), FakeMandrillHandler.calls, len(messages) / elapsed)
+
+
+def main(count=500, latency=5):
+    FakeMandrillHandler.latency = latency / 1000.0
+    server = FakeMandrillServer(('127.0.0.1', 0), FakeMandrillHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    mandrill.ROOT = 'http://127.0.0.1:%d/api/1.0/' % server.server_port
+    messages = make_messages(count)
+    run('before', before, messages)
+    run('after', after, messages)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
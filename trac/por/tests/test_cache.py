@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from trac.por.cache import LRUCache, bump_generation, get_generation
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """Bounded/expiring cache used by the monkey patches"""
+
+    def test_get_builds_once(self):
+        cache = LRUCache()
+        calls = []
+        def builder():
+            calls.append(1)
+            return 'value'
+        self.assertEqual(cache.get('key', builder), 'value')
+        self.assertEqual(cache.get('key', builder), 'value')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_generation(self):
+        cache = LRUCache()
+        cache.store('key', 'old', get_generation('TestTopic'))
+        self.assertEqual(cache.lookup('key', get_generation('TestTopic')), 'old')
+        bump_generation('TestTopic')
+        self.assertRaises(KeyError, cache.lookup, 'key', get_generation('TestTopic'))
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=-1)
+        cache.store('key', 'value')
+        self.assertRaises(KeyError, cache.lookup, 'key')
+
+    def test_maxsize(self):
+        cache = LRUCache(maxsize=2)
+        cache.store('a', 1)
+        cache.store('b', 2)
+        cache.lookup('a')
+        cache.store('c', 3)
+        self.assertEqual(cache.lookup('a'), 1)
+        self.assertRaises(KeyError, cache.lookup, 'b')
+
+    def test_invalidate(self):
+        cache = LRUCache()
+        cache.store('a', 1)
+        cache.store('b', 2)
+        cache.invalidate('a')
+        self.assertRaises(KeyError, cache.lookup, 'a')
+        cache.invalidate()
+        self.assertEqual(cache.stats()['size'], 0)
+
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from beaker.cache import cache_regions
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import penelope.core.models
+from penelope.core.models import Base
+from penelope.core.models.dashboard import Group, Project, Role, User
+from penelope.core.security import acl; acl # registers the role finders
+
+from trac.test import EnvironmentStub
+
+from trac.por.context import NO_ROLE, PorContext, get_context, load_project_roles, \
+                             short_lived_session
+
+import unittest
+
+
+class LoadProjectRolesTestCase(unittest.TestCase):
+    """load_project_roles agrees with User.roles_in_context"""
+
+    def setUp(self):
+        # roles_in_context reads the roles matrix through a beaker region
+        # and penelope.core.models.DBSession
+        cache_regions.setdefault('calculate_matrix', {'type': 'memory', 'expire': 0,
+                                                      'enabled': False})
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+
+        class MockSession(sessionmaker()):
+            def __call__(self):
+                return self
+        self.session = MockSession(bind=self.engine)
+        self.dbsession = penelope.core.models.DBSession
+        penelope.core.models.DBSession = self.session
+
+        roles = dict([(name, Role(name=name)) for name in
+                      (u'administrator', u'secretary', u'internal_developer',
+                       u'external_developer', u'customer', u'project_manager')])
+        users = dict([(name, User(email=u'%s@example.org' % name, fullname=name))
+                      for name in ('admin', 'secretary', 'developer', 'customer',
+                                   'manager', 'author', 'elsewhere', 'member', 'nobody')])
+        users['admin'].roles.append(roles[u'administrator'])
+        users['secretary'].roles.extend([roles[u'secretary'], roles[u'internal_developer']])
+        self.project = Project(name=u'Foo', manager=users['manager'],
+                               author=users['author'])
+        other = Project(name=u'Bar')
+        developers = Group(project=self.project)
+        developers.roles.append(roles[u'internal_developer'])
+        developers.users.extend([users['developer'], users['admin']])
+        customers = Group(project=self.project)
+        customers.roles.append(roles[u'customer'])
+        customers.users.append(users['customer'])
+        members = Group(project=self.project)
+        members.users.extend([users['member'], users['customer']])
+        managers = Group(project=other)
+        managers.roles.append(roles[u'project_manager'])
+        managers.users.append(users['elsewhere'])
+        self.session.add_all(users.values() + [self.project, other])
+        self.session.commit()
+        self.users = users
+
+    def tearDown(self):
+        penelope.core.models.DBSession = self.dbsession
+        self.session.close()
+        Base.metadata.drop_all(self.engine)
+
+    def test_same_roles(self):
+        roles = load_project_roles(self.session, self.project)
+        for name, user in self.users.items():
+            self.assertEqual(sorted(roles.get(user.email, [])),
+                             sorted(user.roles_in_context(context=self.project)),
+                             name)
+        self.assertEqual(roles['developer@example.org'],
+                         frozenset([u'internal_developer', u'local_developer']))
+        self.assertEqual(roles['elsewhere@example.org'],
+                         frozenset([u'local_project_manager']))
+        self.assertTrue(u'administrator' in roles['admin@example.org'])
+        self.assertFalse(u'local_developer' in roles['admin@example.org'])
+        self.assertFalse('nobody@example.org' in roles)
+
+    def test_group_without_roles(self):
+        roles = load_project_roles(self.session, self.project)
+        self.assertEqual(roles['member@example.org'], frozenset([NO_ROLE]))
+        self.assertEqual(roles['customer@example.org'], frozenset([u'customer', NO_ROLE]))
+        self.assertEqual(roles['member@example.org'],
+                         frozenset(self.users['member'].roles_in_context(context=self.project)))
+
+    def test_email_case(self):
+        # emails stored before penelope lowercased them
+        self.session.execute(User.__table__.update()
+                             .where(User.__table__.c.id == self.users['developer'].id)
+                             .values(email=u'Developer@Example.org'))
+        self.session.commit()
+        context = PorContext(self.session, self.project.id)
+        self.assertEqual(sorted(context.get_roles(u'developer@example.org')),
+                         [u'internal_developer', u'local_developer'])
+        self.assertEqual(sorted(context.get_roles(u'DEVELOPER@example.org')),
+                         [u'internal_developer', u'local_developer'])
+
+
+class ShortLivedSessionTestCase(unittest.TestCase):
+    """short_lived_session replaces DBSession in get_context"""
+
+    def test_get_context(self):
+        env = EnvironmentStub()
+        env.config.set('por-dashboard', 'project-id', 'foo')
+        with short_lived_session() as session:
+            context = get_context(env)
+            self.assertTrue(context.session is session)
+            self.assertTrue(get_context(env) is context)
+        self.assertFalse(get_context(env).session is session)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.ticket.model import Ticket
+from trac.web.href import Href
+
+from trac.por.plugins import TicketRPC, id_prefix_ranges, intersect_id_ranges
+from trac.por.ticketindex import TicketIndex
+
+import unittest
+
+
+class IdRangesTestCase(unittest.TestCase):
+    """id^= conditions are translated to id ranges"""
+
+    def test_prefix_ranges(self):
+        self.assertEqual(id_prefix_ranges('1', 130),
+                         [(1, 1), (10, 19), (100, 130)])
+        self.assertEqual(id_prefix_ranges('1', 130, min_id=15),
+                         [(15, 19), (100, 130)])
+        self.assertEqual(id_prefix_ranges('12', 1250, min_id=121),
+                         [(121, 129), (1200, 1250)])
+        self.assertEqual(id_prefix_ranges('2', 1), [])
+        self.assertEqual(id_prefix_ranges('0', 100), [])
+        self.assertEqual(id_prefix_ranges('a', 100), [])
+
+    def test_intersect(self):
+        self.assertEqual(intersect_id_ranges([(1, 1), (10, 19), (100, 130)],
+                                             [(5, 12), (15, 15), (120, 200)]),
+                         [(10, 12), (15, 15), (120, 130)])
+        self.assertEqual(intersect_id_ranges([(1, 5)], [(6, 9)]), [])
+
+
+class TicketRPCTestCase(unittest.TestCase):
+    """queryWithDetails and queryWithDetailsCursor id conditions"""
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', TicketIndex, TicketRPC])
+        self.env.config.set('ticket-custom', 'customerrequest', 'text')
+        self.env.config.set('ticket-custom', 'sensitive', 'checkbox')
+        db = self.env.get_db_cnx()
+        TicketIndex(self.env).upgrade_environment(db)
+        db.commit()
+        for i in range(130):
+            ticket = Ticket(self.env)
+            ticket.populate({'summary': u'Foo', 'reporter': 'joe', 'status': 'new'})
+            ticket.insert()
+        self.req = Mock(href=Href('/'), abs_href=Href('http://example.org/'),
+                        perm=MockPerm(), authname='joe', tz=None, args={},
+                        locale=None)
+        self.rpc = TicketRPC(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _ids(self, qstr):
+        return [t['id'] for t in self.rpc.queryWithDetails(self.req, qstr, ['id'])]
+
+    def test_prepare_query(self):
+        self.assertEqual(self.rpc._prepare_query('status=new&id^=12'),
+                         'status=new&id=12,120-129')
+        self.assertEqual(self.rpc._prepare_query('id^=1', after=15),
+                         'id=16-19,100-130')
+        self.assertEqual(self.rpc._prepare_query('id=1-20|125&id^=1'),
+                         'id=1,10-19,125')
+        self.assertEqual(self.rpc._prepare_query('id=5&id^=1'), None)
+        self.assertEqual(self.rpc._prepare_query('id^=999'), None)
+        self.assertEqual(self.rpc._prepare_query('status=new'), 'status=new')
+
+    def test_prefix_and_id(self):
+        self.assertEqual(self._ids('id=5&id^=1&max=0'), [])
+        self.assertEqual(self._ids('id=10-20&id^=2&max=0'), [20])
+        self.assertEqual(self._ids('id^=13&or&id=3&max=0'), [3, 13, 130])
+
+    def test_cursor_with_id(self):
+        cursor, ids = '', []
+        for call in range(5):
+            page = self.rpc.queryWithDetailsCursor(self.req, 'id=1-5|128-200', ['id'],
+                                                   cursor, 2)
+            ids.extend([t['id'] for t in page['tickets']])
+            cursor = page['cursor']
+            if not cursor:
+                break
+        self.assertEqual(cursor, '')
+        self.assertEqual(ids, [1, 2, 3, 4, 5, 128, 129, 130])
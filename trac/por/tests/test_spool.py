@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+
+from trac.core import Component, implements
+from trac.test import EnvironmentStub
+
+from trac.por.notification import IMandrillTransport, NotificationSpool, _workers, stop_workers
+
+import unittest
+
+
+class FakeMandrillTransport(Component):
+    """Local stand-in for the Mandrill API"""
+    implements(IMandrillTransport)
+
+    sent = []
+    failures = 0
+
+    def send_template(self, template_name, message):
+        if FakeMandrillTransport.failures:
+            FakeMandrillTransport.failures -= 1
+            raise IOError('Mandrill is down')
+        FakeMandrillTransport.sent.append((template_name, message))
+
+
+class NotificationSpoolTestCase(unittest.TestCase):
+    """Notifications are spooled and delivered by the workers"""
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', FakeMandrillTransport])
+        self.env.config.set('notification', 'mandrill_transport', 'FakeMandrillTransport')
+        self.env.config.set('notification', 'mandrill_workers', '0')
+        self.env.config.set('notification', 'mandrill_retry_delay', '0')
+        self.env.config.set('notification', 'mandrill_max_attempts', '3')
+        self.spool = NotificationSpool(self.env)
+        db = self.env.get_db_cnx()
+        self.spool.upgrade_environment(db)
+        db.commit()
+        FakeMandrillTransport.sent = []
+        FakeMandrillTransport.failures = 0
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _statuses(self):
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT status, attempts FROM por_notification_spool")
+        return cursor.fetchall()
+
+    def test_delivery(self):
+        self.spool.enqueue('ticket', {'subject': u'Foo', 'to': [{'email': 'joe@example.org'}]})
+        self.assertEqual(FakeMandrillTransport.sent, [])
+        self.assertEqual(self.spool.deliver_pending(), 1)
+        self.assertEqual(FakeMandrillTransport.sent,
+                         [('ticket', {'subject': u'Foo', 'to': [{'email': 'joe@example.org'}]})])
+        self.assertEqual(self._statuses(), [])
+
+    def test_retry(self):
+        FakeMandrillTransport.failures = 1
+        self.spool.enqueue('ticket', {'subject': u'Foo', 'to': [{'email': 'joe@example.org'}]})
+        self.assertEqual(self.spool.deliver_pending(limit=1), 1)
+        self.assertEqual(self._statuses(), [('queued', 1)])
+        self.spool.deliver_pending()
+        self.assertEqual(len(FakeMandrillTransport.sent), 1)
+        self.assertEqual(self._statuses(), [])
+
+    def test_dead_letter(self):
+        FakeMandrillTransport.failures = 5
+        self.spool.enqueue('ticket', {'subject': u'Foo', 'to': [{'email': 'joe@example.org'}]})
+        self.assertEqual(self.spool.deliver_pending(), 3)
+        self.assertEqual(FakeMandrillTransport.sent, [])
+        self.assertEqual(self._statuses(), [('dead', 3)])
+
+    def test_coalesce(self):
+        self.env.config.set('notification', 'mandrill_coalesce_window', '60')
+        self.env.config.set('notification', 'mandrill_batch_size', '1')
+        def message(author, comment, recipients):
+            return {'subject': u'#1: Foo (%s)' % author,
+                    'global_merge_vars': [{'name': 'change_author', 'content': author},
+                                          {'name': 'change_comment', 'content': comment}],
+                    'to': [{'email': r} for r in recipients]}
+        self.spool.enqueue('ticket', message(u'joe', u'<p>one</p>', ['joe@example.org', 'mary@example.net']),
+                           ticket='/ticket/1')
+        self.spool.enqueue('ticket', message(u'jim', u'<p>two</p>', ['joe@example.org']),
+                           ticket='/ticket/1')
+        self.assertEqual(self.spool.deliver_pending(), 0)
+        db = self.env.get_db_cnx()
+        db.cursor().execute("UPDATE por_notification_spool SET next_attempt=0")
+        db.commit()
+        self.assertEqual(self.spool.deliver_pending(), 2)
+        sent = dict([(m['to'][0]['email'], m) for t, m in FakeMandrillTransport.sent])
+        self.assertEqual(len(sent['joe@example.org']['to']), 1)
+        merge_vars = dict([(v['name'], v['content']) for v in sent['joe@example.org']['global_merge_vars']])
+        self.assertEqual(merge_vars['change_author'], u'joe, jim')
+        self.assertEqual(merge_vars['change_comment'],
+                         u'<p><strong>joe</strong></p><p>one</p><p><strong>jim</strong></p><p>two</p>')
+        self.assertEqual(sent['joe@example.org']['subject'], u'#1: Foo (joe)')
+        merge_vars = dict([(v['name'], v['content']) for v in sent['mary@example.net']['global_merge_vars']])
+        self.assertEqual(merge_vars['change_comment'], u'<p>one</p>')
+
+    def test_concurrent_merge(self):
+        self.env.config.set('notification', 'mandrill_coalesce_window', '60')
+        message = lambda subject: {'subject': subject, 'to': [{'email': 'joe@example.org'}]}
+        self.spool.enqueue('ticket', message(u'one'), ticket='/ticket/1')
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT id FROM por_notification_spool")
+        id = cursor.fetchone()[0]
+
+        class ConcurrentCursor(object):
+            # another change of the ticket is merged between the read and
+            # the update of the held notification
+            concurrent = True
+            def __getattr__(self, name):
+                return getattr(cursor, name)
+            def execute(self, sql, args=()):
+                if sql.strip().startswith('UPDATE') and self.concurrent:
+                    self.concurrent = False
+                    spool._join_held(cursor, id, '/ticket/1', 0, 'ticket',
+                                     message(u'two'), ['joe@example.org'])
+                return cursor.execute(sql, args)
+        spool = self.spool
+        self.assertEqual(spool._join_held(ConcurrentCursor(), id, '/ticket/1', 0, 'ticket',
+                                          message(u'three'), ['joe@example.org']), [])
+        cursor.execute("SELECT payload FROM por_notification_spool")
+        payloads = [json.loads(payload) for (payload,) in cursor.fetchall()]
+        self.assertEqual([[m['subject'] for m in p['messages']] for p in payloads],
+                         [[u'one', u'two', u'three']])
+
+    def test_batch(self):
+        for i, email in enumerate(['joe@example.org', 'mary@example.net', 'joe@example.org']):
+            self.spool.enqueue('ticket', {'subject': u'#%s: Foo' % i,
+                                          'global_merge_vars': [{'name': 'ticket_link', 'content': i}],
+                                          'to': [{'email': email}]})
+        self.assertEqual(self.spool.deliver_pending(), 3)
+        self.assertEqual(len(FakeMandrillTransport.sent), 2)
+        template, message = FakeMandrillTransport.sent[0]
+        self.assertEqual(message['subject'], u'*|POR_SUBJECT|*')
+        self.assertEqual([to['email'] for to in message['to']], ['joe@example.org', 'mary@example.net'])
+        self.assertEqual(message['merge_vars'][1],
+                         {'rcpt': 'mary@example.net',
+                          'vars': [{'name': 'ticket_link', 'content': 1},
+                                   {'name': 'por_subject', 'content': u'#1: Foo'}]})
+        template, message = FakeMandrillTransport.sent[1]
+        self.assertEqual(message['subject'], u'#2: Foo')
+        self.assertEqual(self._statuses(), [])
+
+    def test_interrupted(self):
+        self.spool.enqueue('ticket', {'subject': u'Foo', 'to': [{'email': 'joe@example.org'}]})
+        db = self.env.get_db_cnx()
+        for attempts in range(3):
+            # claimed by a worker dying before the end of the delivery
+            self.assertEqual([c[2] for c in self.spool._claim(1)], [attempts])
+            db.cursor().execute("UPDATE por_notification_spool SET next_attempt=0")
+            db.commit()
+        self.assertEqual(self.spool._claim(1), [])
+        self.assertEqual(self._statuses(), [('dead', 3)])
+
+    def test_workers(self):
+        # a notification left in the spool by a previous process: enqueuing
+        # does not start workers
+        self.spool.enqueue('ticket', {'subject': u'Foo', 'to': [{'email': 'joe@example.org'}]})
+        self.assertFalse(self.env.path in _workers)
+        self.env.config.set('notification', 'mandrill_workers', '1')
+        self.assertEqual(self.spool.pre_process_request(None, 'handler'), 'handler')
+        workers = _workers[self.env.path]
+        try:
+            for i in range(50):
+                if FakeMandrillTransport.sent:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(len(FakeMandrillTransport.sent), 1)
+            self.spool.pre_process_request(None, 'handler')
+            self.assertTrue(_workers[self.env.path] is workers)
+        finally:
+            stop_workers(self.env)
+        for thread in workers.threads:
+            thread.join(5)
+            self.assertFalse(thread.isAlive())
+        self.assertFalse(self.env.path in _workers)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime, timedelta
+
+from trac.test import EnvironmentStub
+from trac.ticket.model import Ticket
+from trac.util.datefmt import to_utimestamp, utc
+
+from trac.por.ticketindex import DELETED_RETENTION, SYNC_LAG, TicketIndex, now_utimestamp
+
+import unittest
+
+
+class TicketIndexTestCase(unittest.TestCase):
+    """The ticket index follows the ticket changes"""
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True, enable=['trac.*', TicketIndex])
+        self.env.config.set('ticket-custom', 'customerrequest', 'select')
+        self.env.config.set('ticket-custom', 'sensitive', 'checkbox')
+        self.index = TicketIndex(self.env)
+        db = self.env.get_db_cnx()
+        self.index.upgrade_environment(db)
+        db.commit()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _ticket(self, when=None, **values):
+        ticket = Ticket(self.env)
+        ticket.populate(dict(summary=u'Foo', reporter='joe', status='new', **values))
+        ticket.insert(when=when)
+        return ticket
+
+    def test_created_and_changed(self):
+        ticket = self._ticket(customerrequest='cr1', sensitive='1')
+        self.assertEqual(self.index.query(),
+                         [{'ticket': ticket.id, 'customerrequest': 'cr1', 'sensitive': 1,
+                           'status': 'new', 'resolution': None,
+                           'changetime': to_utimestamp(ticket['changetime'])}])
+        ticket['customerrequest'] = 'cr2'
+        ticket['sensitive'] = '0'
+        ticket['status'] = 'closed'
+        ticket['resolution'] = 'fixed'
+        ticket.save_changes('joe', u'done', when=ticket['changetime'] + timedelta(seconds=1))
+        self.assertEqual(self.index.query("ticket=%s", (ticket.id,)),
+                         [{'ticket': ticket.id, 'customerrequest': 'cr2', 'sensitive': 0,
+                           'status': 'closed', 'resolution': 'fixed',
+                           'changetime': to_utimestamp(ticket['changetime'])}])
+
+    def test_deleted(self):
+        ticket = self._ticket(customerrequest='cr1')
+        ticket.delete()
+        self.assertEqual(self.index.query(), [])
+
+    def test_update_existing(self):
+        ticket = self._ticket(customerrequest='cr1')
+        self.index.update(ticket)
+        self.assertEqual([row['ticket'] for row in self.index.query()], [ticket.id])
+        self.index.ticket_deleted(ticket)
+        self.index.ticket_deleted(ticket)
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT ticket FROM por_ticket_deleted")
+        self.assertEqual(cursor.fetchall(), [(ticket.id,)])
+
+    def test_purge_deleted(self):
+        old, recent, ticket = self._ticket(), self._ticket(), self._ticket()
+        db = self.env.get_db_cnx()
+        db.cursor().executemany("INSERT INTO por_ticket_deleted (ticket, time) VALUES (%s, %s)",
+                                [(old.id, now_utimestamp() - DELETED_RETENTION - 1000000),
+                                 (recent.id, now_utimestamp() - DELETED_RETENTION + 60000000)])
+        db.commit()
+        ticket.delete()
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT ticket FROM por_ticket_deleted ORDER BY ticket")
+        self.assertEqual(cursor.fetchall(), [(recent.id,), (ticket.id,)])
+
+    def test_retry(self):
+        # a concurrent listener inserting the same row makes the first
+        # attempt fail
+        calls = []
+        def do_update(db):
+            calls.append(db)
+            if len(calls) == 1:
+                raise ValueError('duplicate key')
+        self.index._with_retry(do_update)
+        self.assertEqual(len(calls), 2)
+
+    def test_rebuild(self):
+        first = self._ticket(customerrequest='cr1', sensitive='1')
+        second = self._ticket()
+        db = self.env.get_db_cnx()
+        db.cursor().execute("DELETE FROM por_ticket_index")
+        db.cursor().execute("UPDATE ticket_custom SET value='cr3' WHERE ticket=%s AND name='customerrequest'",
+                            (first.id,))
+        self.index.rebuild(db)
+        db.commit()
+        rows = self.index.query()
+        self.assertEqual([(r['ticket'], r['customerrequest'], r['sensitive']) for r in rows],
+                         [(first.id, 'cr3', 1), (second.id, second.values.get('customerrequest'), 0)])
+
+    def test_lookup(self):
+        self.index.chunk_size = 2
+        tickets = [self._ticket(customerrequest='cr%s' % i) for i in range(5)]
+        rows = self.index.lookup([t.id for t in tickets[1:]] + [tickets[1].id, 999])
+        self.assertEqual(sorted(rows), [t.id for t in tickets[1:]])
+        self.assertEqual(rows[tickets[3].id]['customerrequest'], 'cr3')
+        self.assertEqual(self.index.lookup([]), {})
+
+    def test_changes_since(self):
+        self._ticket(when=datetime(2013, 1, 1, tzinfo=utc))
+        changed = self._ticket(when=datetime(2013, 1, 2, tzinfo=utc), customerrequest='cr1')
+        deleted = self._ticket(when=datetime(2013, 1, 2, tzinfo=utc))
+        deleted.delete()
+        since = to_utimestamp(datetime(2013, 1, 1, 12, tzinfo=utc))
+        rows, deleted_ids, watermark = self.index.changes_since(since)
+        self.assertEqual([row['ticket'] for row in rows], [changed.id])
+        self.assertEqual(deleted_ids, [deleted.id])
+        # the deletion is too recent: sent again at the next call
+        self.assertTrue(to_utimestamp(datetime(2013, 1, 2, tzinfo=utc)) < watermark <
+                        to_utimestamp(datetime.now(utc)) - SYNC_LAG + 1000000)
+        self.assertEqual(self.index.changes_since(watermark)[:2], ([], [deleted.id]))
+
+    def test_customer_requests(self):
+        self.index.chunk_size = 2
+        tickets = [self._ticket(customerrequest='cr%s' % i) for i in range(5)]
+        self.assertEqual(self.index.customer_requests([t.id for t in tickets[:3]] + [999]),
+                         dict([(t.id, 'cr%s' % i) for i, t in enumerate(tickets[:3])]))
+        self.assertEqual(self.index.customer_requests([]), {})
+
+    def test_outdated(self):
+        tickets = [self._ticket() for i in range(3)]
+        db = self.env.get_db_cnx()
+        db.cursor().execute("UPDATE ticket SET changetime=changetime+1 WHERE id=%s",
+                            (tickets[0].id,))
+        db.cursor().execute("DELETE FROM por_ticket_index WHERE ticket=%s", (tickets[1].id,))
+        db.commit()
+        self.assertEqual(self.index.outdated([t.id for t in tickets] + [999]),
+                         set([tickets[0].id, tickets[1].id]))
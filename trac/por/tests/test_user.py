@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+from trac.core import Component, implements
+from trac.perm import IPermissionPolicy, IPermissionRequestor, PermissionCache, PermissionSystem
+from trac.test import EnvironmentStub, Mock
+from trac.ticket.model import Ticket
+
+from trac.por import user
+from trac.por.ticketindex import TicketIndex
+from trac.por.user import viewable_tickets
+
+import unittest
+
+
+class SensitiveTicketsPolicy(Component):
+    """Local stand-in for the sensitivetickets policy"""
+    implements(IPermissionPolicy, IPermissionRequestor)
+
+    checked = []
+
+    def get_permission_actions(self):
+        return ['SENSITIVE_VIEW']
+
+    def check_permission(self, action, username, resource, perm):
+        if action == 'TICKET_VIEW' and resource and resource.realm == 'ticket' and \
+                resource.id is not None and 'SENSITIVE_VIEW' not in perm:
+            SensitiveTicketsPolicy.checked.append(resource.id)
+            if Ticket(self.env, resource.id).values.get('sensitive') == '1':
+                return False
+
+
+class OddTicketsPolicy(Component):
+    """A policy whose decision depends on the ticket"""
+    implements(IPermissionPolicy)
+
+    def check_permission(self, action, username, resource, perm):
+        if action == 'TICKET_VIEW' and resource and resource.realm == 'ticket' and \
+                resource.id is not None and resource.id % 2:
+            return False
+
+
+class ViewableTicketsTestCase(unittest.TestCase):
+    """viewable_tickets agrees with the per-ticket permission checks"""
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', TicketIndex, SensitiveTicketsPolicy,
+                                           OddTicketsPolicy])
+        self.env.config.set('ticket-custom', 'sensitive', 'checkbox')
+        self.env.config.set('trac', 'permission_policies',
+                            'SensitiveTicketsPolicy, DefaultPermissionPolicy')
+        db = self.env.get_db_cnx()
+        TicketIndex(self.env).upgrade_environment(db)
+        db.commit()
+        self.tickets = []
+        for sensitive in ('0', '1', '0', '1'):
+            ticket = Ticket(self.env)
+            ticket.populate({'summary': u'Foo', 'reporter': 'joe', 'status': 'new',
+                             'sensitive': sensitive})
+            ticket.insert()
+            self.tickets.append(ticket.id)
+        permsys = PermissionSystem(self.env)
+        permsys.revoke_permission('anonymous', 'TICKET_VIEW')
+        permsys.grant_permission('joe', 'TICKET_VIEW')
+        permsys.grant_permission('mary', 'TICKET_VIEW')
+        permsys.grant_permission('mary', 'SENSITIVE_VIEW')
+        self.policies = user.TICKET_AGNOSTIC_POLICIES
+        user.TICKET_AGNOSTIC_POLICIES += (SensitiveTicketsPolicy,)
+
+    def tearDown(self):
+        user.TICKET_AGNOSTIC_POLICIES = self.policies
+        self.env.reset_db()
+
+    def _viewable(self, username, index=None):
+        req = Mock(perm=PermissionCache(self.env, username), authname=username)
+        expected = set([id for id in self.tickets
+                        if 'TICKET_VIEW' in PermissionCache(self.env, username)('ticket', id)])
+        viewable = viewable_tickets(self.env, req, self.tickets, index)
+        self.assertEqual(viewable, expected)
+        return sorted(viewable)
+
+    def test_sensitive(self):
+        first, second, third, fourth = self.tickets
+        self.assertEqual(self._viewable('joe'), [first, third])
+        self.assertEqual(self._viewable('mary'), self.tickets)
+        self.assertEqual(self._viewable('anonymous'), [])
+
+    def test_not_indexed(self):
+        first, second, third, fourth = self.tickets
+        db = self.env.get_db_cnx()
+        db.cursor().execute("DELETE FROM por_ticket_index WHERE ticket IN (%s, %s)",
+                            (first, second))
+        db.commit()
+        self.assertEqual(self._viewable('joe'), [first, third])
+        self.assertEqual(self._viewable('joe', index={}), [first, third])
+
+    def test_outdated(self):
+        first, second, third, fourth = self.tickets
+        # made sensitive behind trac's back
+        db = self.env.get_db_cnx()
+        db.cursor().execute("UPDATE ticket_custom SET value='1' "
+                            "WHERE ticket=%s AND name='sensitive'", (first,))
+        db.cursor().execute("UPDATE ticket SET changetime=changetime+1 WHERE id=%s", (first,))
+        db.commit()
+        self.assertEqual(self._viewable('joe'), [third])
+
+    def test_policy_class(self):
+        first, second, third, fourth = self.tickets
+        req = Mock(perm=PermissionCache(self.env, 'joe'), authname='joe')
+        SensitiveTicketsPolicy.checked = []
+        viewable_tickets(self.env, req, self.tickets)
+        self.assertEqual(SensitiveTicketsPolicy.checked, [second, fourth])
+        # a policy is trusted by its class, not by its name
+        user.TICKET_AGNOSTIC_POLICIES = self.policies
+        req = Mock(perm=PermissionCache(self.env, 'joe'), authname='joe')
+        SensitiveTicketsPolicy.checked = []
+        viewable_tickets(self.env, req, self.tickets)
+        self.assertEqual(SensitiveTicketsPolicy.checked, self.tickets)
+
+    def test_ticket_dependent_policy(self):
+        first, second, third, fourth = self.tickets
+        self.env.config.set('trac', 'permission_policies',
+                            'OddTicketsPolicy, SensitiveTicketsPolicy, DefaultPermissionPolicy')
+        self.assertEqual(self._viewable('mary'), [second, fourth])
+        self.assertEqual(self._viewable('joe'), [])
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Compact index of the ticket fields the penelope dashboard looks tickets up
+by: customer request, sensitive flag, status and resolution.
+
+The customer request and the sensitive flag are trac custom fields, stored
+as name/value rows of ticket_custom; the RPC lookups used to scan that
+table. The index keeps one indexed row per ticket in `por_ticket_index`,
+updated by an ITicketChangeListener. Changes made behind trac's back (raw
+SQL, ticket_custom edits) are picked up by::
+
+    trac-admin /path/to/env ticketindex rebuild
+
+The index also keeps the change time of the tickets and the ids of the
+deleted ones, so that clients can ask for what changed since their last
+synchronization. Deleted tickets are forgotten after DELETED_RETENTION.
+"""
+
+import time
+
+from trac.admin.api import IAdminCommandProvider
+from trac.core import Component, implements
+from trac.db import Column, DatabaseManager, Index, Table
+from trac.env import IEnvironmentSetupParticipant
+from trac.ticket.api import ITicketChangeListener
+from trac.util.datefmt import to_utimestamp
+from trac.util.text import printout
+
+
+DB_NAME = 'por_ticket_index'
+DB_VERSION = 1
+
+SCHEMA = [
+    Table('por_ticket_index', key='ticket')[
+        Column('ticket', type='int'),
+        Column('customerrequest'),
+        Column('sensitive', type='int'),
+        Column('status'),
+        Column('resolution'),
+        Column('changetime', type='int64'),
+        Index(['customerrequest']),
+        Index(['sensitive']),
+        Index(['changetime'])],
+    Table('por_ticket_deleted', key='ticket')[
+        Column('ticket', type='int'),
+        Column('time', type='int64'),
+        Index(['time'])],
+]
+
+INDEX_COLUMNS = ('ticket', 'customerrequest', 'sensitive', 'status', 'resolution',
+                 'changetime')
+
+# microseconds a change may take to reach the index after its change time
+# (the listeners run after the ticket transaction has been committed)
+SYNC_LAG = 5 * 1000000
+
+# microseconds the deleted tickets are kept for, well past SYNC_LAG: a
+# client synchronizing less often must start over from scratch
+DELETED_RETENTION = 30 * 24 * 3600 * 1000000
+
+
+class TicketIndex(Component):
+    """Side table of the ticket customer request and sensitive flag."""
+    implements(IEnvironmentSetupParticipant, ITicketChangeListener,
+               IAdminCommandProvider)
+
+    chunk_size = 1000 # ticket ids per lookup query
+    array_chunk_size = 10000 # ticket ids per lookup query, with arrays
+
+    # IEnvironmentSetupParticipant methods
+    def environment_created(self):
+        @self.env.with_transaction()
+        def do_create(db):
+            self.upgrade_environment(db)
+
+    def environment_needs_upgrade(self, db):
+        cursor = db.cursor()
+        cursor.execute("SELECT value FROM system WHERE name=%s", (DB_NAME,))
+        row = cursor.fetchone()
+        return not row or int(row[0]) < DB_VERSION
+
+    def upgrade_environment(self, db):
+        connector, _ = DatabaseManager(self.env)._get_connector()
+        cursor = db.cursor()
+        for table in SCHEMA:
+            for stmt in connector.to_sql(table):
+                cursor.execute(stmt)
+        self.rebuild(db)
+        cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                       (DB_NAME, str(DB_VERSION)))
+
+    # ITicketChangeListener methods
+    def ticket_created(self, ticket):
+        self.update(ticket)
+
+    def ticket_changed(self, ticket, comment, author, old_values):
+        self.update(ticket)
+
+    def ticket_deleted(self, ticket):
+        def do_delete(db):
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM por_ticket_index WHERE ticket=%s", (ticket.id,))
+            now = now_utimestamp()
+            cursor.execute("DELETE FROM por_ticket_deleted WHERE time < %s",
+                           (now - DELETED_RETENTION,))
+            upsert(cursor, 'por_ticket_deleted', 'ticket', {'ticket': ticket.id, 'time': now})
+        self._with_retry(do_delete)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('ticketindex rebuild', '',
+               'Rebuild the index of the ticket customer requests and '
+               'sensitive flags',
+               None, self._do_rebuild)
+
+    def _do_rebuild(self):
+        @self.env.with_transaction()
+        def do_rebuild(db):
+            self.rebuild(db)
+        cursor = self.env.get_db_cnx().cursor()
+        cursor.execute("SELECT COUNT(*) FROM por_ticket_index")
+        printout('%s tickets indexed' % cursor.fetchone()[0])
+
+    # public API
+    def update(self, ticket):
+        """Store the indexed fields of `ticket`."""
+        row = {
+            'ticket': ticket.id,
+            'customerrequest': ticket.values.get('customerrequest'),
+            'sensitive': int(ticket.values.get('sensitive') == '1'),
+            'status': ticket.values.get('status'),
+            'resolution': ticket.values.get('resolution'),
+            'changetime': to_utimestamp(ticket.values.get('changetime')),
+        }
+
+        def do_update(db):
+            cursor = db.cursor()
+            cursor.execute("DELETE FROM por_ticket_deleted WHERE ticket=%s", (ticket.id,))
+            upsert(cursor, 'por_ticket_index', 'ticket', row)
+        self._with_retry(do_update)
+
+    def _with_retry(self, do_update):
+        # the listeners run after the ticket has been committed: a failure
+        # would be reported to a request that actually succeeded. The only
+        # expected one is a concurrent listener inserting the same row
+        # first, in which case the second attempt updates it
+        try:
+            self.env.with_transaction()(do_update)
+        except Exception, e:
+            self.log.debug("Ticket index update failed, retrying: %s", e)
+            self.env.with_transaction()(do_update)
+
+    def rebuild(self, db):
+        """Recompute the index from the ticket tables."""
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM por_ticket_index")
+        cursor.execute("""
+            INSERT INTO por_ticket_index
+                (ticket, customerrequest, sensitive, status, resolution, changetime)
+            SELECT t.id, cr.value,
+                   CASE WHEN s.value='1' THEN 1 ELSE 0 END,
+                   t.status, t.resolution, t.changetime
+            FROM ticket t
+            LEFT OUTER JOIN ticket_custom cr ON (cr.ticket=t.id AND cr.name='customerrequest')
+            LEFT OUTER JOIN ticket_custom s ON (s.ticket=t.id AND s.name='sensitive')""")
+
+    def query(self, where='', args=(), db=None):
+        """Return the index rows matching the `where` SQL condition, as
+        dicts keyed by column name."""
+        db = db or self.env.get_db_cnx()
+        cursor = db.cursor()
+        sql = "SELECT %s FROM por_ticket_index" % ', '.join(INDEX_COLUMNS)
+        if where:
+            sql += " WHERE " + where
+        cursor.execute(sql + " ORDER BY ticket", args)
+        return [dict(zip(INDEX_COLUMNS, row)) for row in cursor]
+
+    def lookup(self, ticket_ids, db=None):
+        """Return the index rows of the given tickets, by ticket id."""
+        rows = {}
+        for where, args in self._ticket_chunks(ticket_ids):
+            for row in self.query(where, args, db=db):
+                rows[row['ticket']] = row
+        return rows
+
+    def customer_requests(self, ticket_ids, db=None):
+        """Return the customer request field of the given tickets, by ticket
+        id. Tickets without the field are left out."""
+        db = db or self.env.get_db_cnx()
+        cursor = db.cursor()
+        result = {}
+        for where, args in self._ticket_chunks(ticket_ids):
+            cursor.execute("SELECT ticket, customerrequest FROM por_ticket_index "
+                           "WHERE customerrequest IS NOT NULL AND " + where, args)
+            result.update(cursor.fetchall())
+        return result
+
+    def outdated(self, ticket_ids, db=None):
+        """Return the ids of the given tickets whose index row is missing or
+        older than the ticket (changed behind trac's back, or not indexed
+        yet)."""
+        db = db or self.env.get_db_cnx()
+        cursor = db.cursor()
+        result = set()
+        for where, args in self._ticket_chunks(ticket_ids, column='t.id'):
+            cursor.execute("SELECT t.id FROM ticket t "
+                           "LEFT OUTER JOIN por_ticket_index i ON (i.ticket=t.id) "
+                           "WHERE (i.ticket IS NULL OR i.changetime < t.changetime) AND " +
+                           where, args)
+            result.update([id for (id,) in cursor])
+        return result
+
+    def _ticket_chunks(self, ticket_ids, column='ticket'):
+        """Yield the (SQL condition, args) selecting the given tickets by
+        `column`, in chunks: `column = ANY(array)` on PostgreSQL (a single,
+        index friendly, statement whatever the number of ids), an IN list
+        of at most `chunk_size` ids on the other databases."""
+        ticket_ids = sorted(set([int(id) for id in ticket_ids]))
+        if DatabaseManager(self.env).connection_uri.startswith('postgres'):
+            size = self.array_chunk_size
+            for start in range(0, len(ticket_ids), size):
+                yield column + " = ANY(%s)", (ticket_ids[start:start + size],)
+        else:
+            size = self.chunk_size
+            for start in range(0, len(ticket_ids), size):
+                chunk = ticket_ids[start:start + size]
+                yield "%s IN (%s)" % (column, ','.join(['%s'] * len(chunk))), chunk
+
+    def watermark(self, db=None):
+        """Return the (last change time, last deletion time) of the tickets,
+        as microsecond timestamps: any ticket change moves the watermark."""
+        db = db or self.env.get_db_cnx()
+        cursor = db.cursor()
+        cursor.execute("SELECT (SELECT MAX(changetime) FROM por_ticket_index), "
+                       "(SELECT MAX(time) FROM por_ticket_deleted)")
+        changetime, deleted = cursor.fetchone()
+        return changetime or 0, deleted or 0
+
+    def changes_since(self, since, db=None):
+        """Return the index rows of the tickets changed after the `since`
+        timestamp (microseconds), the ids of the tickets deleted since then
+        and the watermark to pass at the next call. Changes younger than
+        SYNC_LAG are returned again at the next call, as they may still be
+        followed by older changes reaching the index late."""
+        db = db or self.env.get_db_cnx()
+        rows = self.query("changetime > %s", (since,), db=db)
+        cursor = db.cursor()
+        cursor.execute("SELECT ticket, time FROM por_ticket_deleted WHERE time > %s "
+                       "ORDER BY ticket", (since,))
+        deleted = cursor.fetchall()
+        times = [row['changetime'] for row in rows] + [t for ticket, t in deleted]
+        watermark = min(max(times or [since]), now_utimestamp() - SYNC_LAG)
+        return rows, [ticket for ticket, t in deleted], max(watermark, since)
+
+
+def upsert(cursor, table, key, row):
+    """Update the `row` (a dict) of `table` identified by its `key` column,
+    insert it if missing."""
+    columns = sorted(row)
+    values = [row[column] for column in columns if column != key]
+    cursor.execute("UPDATE %s SET %s WHERE %s=%%s" % (
+                       table, ', '.join(['%s=%%s' % column for column in columns
+                                         if column != key]), key),
+                   values + [row[key]])
+    if cursor.rowcount == 0:
+        cursor.execute("INSERT INTO %s (%s) VALUES (%s)" % (
+                           table, ', '.join(columns), ', '.join(['%s'] * len(columns))),
+                       [row[column] for column in columns])
+
+
+def now_utimestamp():
+    return int(time.time() * 1000000)
@@ -1,8 +1,33 @@
 from trac import core
+from trac.attachment import LegacyAttachmentPolicy
 from trac.perm import IPermissionStore, DefaultPermissionStore, IPermissionGroupProvider
+from trac.perm import DefaultPermissionPolicy, PermissionSystem
+from trac.resource import Resource
 
-from penelope.core.models import DBSession
-from penelope.core.models.dashboard import Project, User
+from trac.por.cache import LRUCache, bump_generation, get_generation
+from trac.por.context import get_context
+from trac.por.ticketindex import TicketIndex
+
+
+# resolved permissions by (trac environment, username)
+permission_cache = LRUCache(maxsize=2048, ttl=120, name='user_permissions')
+
+# penelope models and trac tables the user permissions depend on
+PERMISSION_TOPICS = ('User', 'Group', 'Role', 'Project', 'permission')
+
+# permission policies whose TICKET_VIEW decision does not depend on the
+# ticket, but for sensitivetickets on the sensitive ones
+TICKET_AGNOSTIC_POLICIES = (DefaultPermissionPolicy, LegacyAttachmentPolicy)
+try:
+    from sensitivetickets.sensitivetickets import SensitiveTicketsPolicy
+    TICKET_AGNOSTIC_POLICIES += (SensitiveTicketsPolicy,)
+except ImportError:
+    pass
+try:
+    from privatecomments.privatecomments import PrivateCommentsPolicy
+    TICKET_AGNOSTIC_POLICIES += (PrivateCommentsPolicy,)
+except ImportError:
+    pass
 
  
 class PorPermissionStore(DefaultPermissionStore):
@@ -12,12 +37,9 @@ class PorPermissionStore(DefaultPermissionStore):
     # IPermissionGroupProvider
     def get_permission_groups(self, username):
         # TODO: work only for por/trac on the same wsgi stack
-        project_id = self.env.config.get('por-dashboard', 'project-id')
-        if project_id:
-            project = DBSession().query(Project).get(project_id)
-            user = DBSession().query(User).filter_by(email=username).first()
-            if user:
-                return list(user.roles_in_context(context=project))
+        context = get_context(self.env)
+        if context:
+            return list(context.get_roles(username))
         return list() 
 
     # IPermissionStore
@@ -29,33 +51,170 @@ class PorPermissionStore(DefaultPermissionStore):
         permissions or `False` for explicitly denied permissions."""
         
         # TODO: work only for por/trac on the same wsgi stack
+        actions = permission_cache.get((self.env.path, username),
+                        lambda: self._get_user_permissions(username),
+                        generation=get_generation(*PERMISSION_TOPICS))
+        return list(actions)
+
+    def _get_user_permissions(self, username):
         actions = set(super(PorPermissionStore, self).get_user_permissions(username))
-        project_id = self.env.config.get('por-dashboard', 'project-id')
-        if project_id:
-            project = DBSession().query(Project).get(project_id)
-            user = DBSession().query(User).filter_by(email=username).first()
-            if user:
-                for role in user.roles_in_context(context=project):
-                    actions.update(set(super(PorPermissionStore, self).get_user_permissions(role)))
-        return list(actions) 
-
-    # BBB: Trac dichiara questo metodo ma non mi risulta venga mai utilizzato
-    
-    # def get_users_with_permissions(self, permissions):
-    #    """Retrieve a list of users that have any of the specified permissions.
-    #
-    #    Users are returned as a list of usernames.
-    #    """
-
-    # def get_all_permissions(self):
-    #    """Return all permissions for all users.
-    #   
-    #    The permissions are returned as a list of (subject, action)
-    #   formatted tuples."""
-
-    # def grant_permission(self, username, action):
-    #    """Grant a user permission to perform an action."""
-
-    # def revoke_permission(self, username, action):
-    #    """Revokes the permission of the given user to perform an action."""
+        context = get_context(self.env)
+        if context:
+            for role in context.get_roles(username):
+                actions.update(set(super(PorPermissionStore, self).get_user_permissions(role)))
+        return frozenset(actions)
+
+    def grant_permission(self, username, action):
+        super(PorPermissionStore, self).grant_permission(username, action)
+        bump_generation('permission')
+
+    def revoke_permission(self, username, action):
+        super(PorPermissionStore, self).revoke_permission(username, action)
+        bump_generation('permission')
+
+    def get_users_with_permissions(self, permissions):
+        """Retrieve a list of users that have any of the specified permissions.
+
+        Users are returned as a list of usernames.
+        """
+        permissions = set(permissions)
+        return [username for username, actions in self.get_users_permissions().items()
+                if permissions.intersection(actions)]
+
+    def get_all_permissions(self):
+        """Return all permissions for all users.
+
+        The permissions are returned as a list of (subject, action)
+        formatted tuples. The penelope roles of the project users are
+        returned as groups, i.e. as (username, role) tuples."""
+        permissions = super(PorPermissionStore, self).get_all_permissions()
+        context = get_context(self.env)
+        if context:
+            for username, roles in context.project_roles.items():
+                permissions.extend([(username, role) for role in roles])
+        return permissions
+
+    def get_users_permissions(self, usernames=None):
+        """Return a dict mapping each of `usernames` (by default the users
+        with a role in the project) to its permissions.
+
+        Roles are resolved for the whole project at once and the `permission`
+        table is read once, whatever the number of users."""
+        context = get_context(self.env)
+        project_roles = context and context.project_roles or {}
+        if usernames is None:
+            usernames = project_roles.keys()
+        generation = get_generation(*PERMISSION_TOPICS)
+        result = {}
+        missing = []
+        for username in usernames:
+            try:
+                result[username] = permission_cache.lookup((self.env.path, username), generation)
+            except KeyError:
+                missing.append(username)
+        if missing:
+            db = self.env.get_db_cnx()
+            cursor = db.cursor()
+            cursor.execute("SELECT username,action FROM permission")
+            rows = cursor.fetchall()
+            for username in missing:
+                subjects = set([username])
+                for provider in self.group_providers:
+                    subjects.update(provider.get_permission_groups(username) or [])
+                result[username] = permission_cache.store((self.env.path, username),
+                                                          expand_permissions(subjects, rows),
+                                                          generation)
+        return result
+
+
+def expand_permissions(subjects, rows):
+    """
+    Return the actions granted to any of `subjects` by the (username, action)
+    `rows` of the permission table, following group memberships like
+    DefaultPermissionStore does.
+    """
+    subjects = set(subjects)
+    actions = set()
+    while True:
+        num_users = len(subjects)
+        num_actions = len(actions)
+        for user, action in rows:
+            if user in subjects:
+                if action.isupper():
+                    actions.add(action)
+                else:
+                    # action is actually the name of the permission group
+                    subjects.add(action)
+        if num_users == len(subjects) and num_actions == len(actions):
+            break
+    return frozenset(actions)
+
+
+def get_users_permissions(env, usernames):
+    """
+    Bulk version of `PermissionSystem.get_user_permissions`: return a dict
+    mapping each of `usernames` to the set of its permissions, meta
+    permissions (e.g. TRAC_ADMIN) expanded.
+    """
+    permsys = PermissionSystem(env)
+    store = permsys.store
+    if isinstance(store, PorPermissionStore):
+        users_actions = store.get_users_permissions(usernames)
+    else:
+        users_actions = dict([(username, store.get_user_permissions(username))
+                              for username in usernames])
+    meta = {}
+    for requestor in permsys.requestors:
+        for action in requestor.get_permission_actions() or []:
+            if isinstance(action, tuple):
+                meta[action[0]] = action[1]
+
+    def expand_meta(action, permissions):
+        if action not in permissions:
+            permissions.add(action)
+            for perm in meta.get(action, []):
+                expand_meta(perm, permissions)
+
+    result = {}
+    for username, actions in users_actions.items():
+        permissions = set()
+        for action in actions or []:
+            expand_meta(action, permissions)
+        result[username] = permissions
+    return result
+
+
+def viewable_tickets(env, req, ticket_ids, index=None):
+    """
+    Return the set of `ticket_ids` the user of `req` has TICKET_VIEW on.
 
+    When all the permission policies are in TICKET_AGNOSTIC_POLICIES,
+    TICKET_VIEW and SENSITIVE_VIEW are checked once for the whole list and
+    the policy chain only runs for the sensitive tickets of users without
+    SENSITIVE_VIEW, and for the tickets whose index row may be stale;
+    otherwise every ticket is checked. `index` are the TicketIndex rows of
+    the tickets, if already looked up.
+    """
+    ticket_ids = list(ticket_ids)
+    policies = [policy.__class__ for policy in PermissionSystem(env).policies]
+    if [p for p in policies if p not in TICKET_AGNOSTIC_POLICIES] or \
+            'TICKET_VIEW' not in req.perm:
+        to_check = ticket_ids
+    elif 'SENSITIVE_VIEW' in req.perm:
+        return set(ticket_ids)
+    else:
+        ticket_index = TicketIndex(env)
+        if index is None:
+            index = ticket_index.lookup(ticket_ids)
+        # tickets missing from the index, or changed since they have been
+        # indexed, are checked as well
+        to_check = [tid for tid in ticket_ids
+                    if tid not in index or index[tid]['sensitive']]
+        checked = set(to_check)
+        outdated = ticket_index.outdated([tid for tid in ticket_ids if tid not in checked])
+        to_check.extend([tid for tid in ticket_ids if tid in outdated])
+    ticket_realm = Resource('ticket')
+    viewable = set(ticket_ids) - set(to_check)
+    viewable.update([tid for tid in to_check
+                     if 'TICKET_VIEW' in req.perm(ticket_realm(id=tid))])
+    return viewable